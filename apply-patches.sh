@@ -7,21 +7,55 @@ set -e
 
 date # Add a timestamp to the log
 
-# unpack and zip archives, tarballs etc
+# Expand archives.  They can only be attachments, so they're at the top level.
+# A broken archive is reported as a failure to apply, and can't be mistaken
+# for the exit status below.  unzip exits with 1 for mere warnings.
 cd /work/patches
-for f in $(find . -name '*.tgz' -o -name '*.tar.gz' -o -name '*.tar.bz2'); do
-	echo "=== expanding $f"
-	tar xzvf $f
-done
-for f in $(find . -name '*.gz'); do
-	echo "=== expanding $f"
-	gunzip $f
-done
-for f in $(find . -name '*.zip'); do
-	echo "=== expanding $f"
-	unzip $f
+for f in *; do
+	case "$f" in
+	*.tar | *.tgz | *.tar.gz | *.tar.bz2)
+		echo "=== expanding $f"
+		tar xvf "$f" || { echo "=== failed to expand $f" && exit 1; }
+		;;
+	*.zip)
+		echo "=== expanding $f"
+		unzip "$f" || [ $? -eq 1 ] || { echo "=== failed to expand $f" && exit 1; }
+		;;
+	esac
 done
 
+# Find the patches, in attachments and in whatever came out of the archives,
+# in a single walk, decompressing them as we go.  Only the list of patches goes
+# to stdout here.
+find . -type f | while read -r f; do
+	case "$f" in
+	*.patch.gz | *.diff.gz)
+		echo "=== expanding $f" >&2
+		gunzip "$f"
+		f=${f%.gz}
+		;;
+	*.patch.bz2 | *.diff.bz2)
+		echo "=== expanding $f" >&2
+		bunzip2 "$f"
+		f=${f%.bz2}
+		;;
+	esac
+	case "$f" in
+	*.patch | *.diff)
+		echo "$f"
+		;;
+	esac
+done | sort >/work/patch-list
+
+# Archives don't always contain patches (they might be benchmark results, for
+# example).  Tell cfbot_patch.py that there was nothing to do here, with an
+# exit status that none of the commands in this script use, before we go to
+# the trouble of preparing the repo.
+if [ ! -s /work/patch-list ]; then
+	echo "=== no patches found"
+	exit 10
+fi
+
 # now apply all .patch and .diff files
 cd /work/postgresql
 
@@ -38,10 +72,61 @@ else
 	PATCH_CMD=patch
 fi
 
-# Somehow this is necessary to avoid "does not match index" when running "git apply"
-git status
+# Make sure the index's stat information is up to date, to avoid "does not
+# match index" when running "git apply".  Unlike "git status", this doesn't go
+# looking for untracked files all over the tree.
+git update-index -q --refresh
+
+# Print the paths that a patch touches, as patch -p1 would see them.
+patch_paths() {
+	sed -n -E \
+		-e 's,^(\+\+\+|---) [^/ 	]+/([^	]*).*$,\2,p' \
+		-e 's,^(rename|copy) (from|to) ,,p' \
+		"$1" | sort -u
+}
 
-for f in $(cd /work/patches && find . -name '*.patch' -o -name '*.diff' | sort); do
+# Undo a failed attempt to apply a patch.  Resetting to HEAD only rewrites
+# tracked files whose stat information doesn't match the index, and untracked
+# files (new files, .rej files) are only looked for in the directories that
+# the patch touches, rather than in the whole tree.
+undo() {
+	git reset -q --hard HEAD
+	if [ -n "$DIRS" ]; then
+		echo "$DIRS" | tr '\n' '\0' | xargs -0 git clean -q -fdx --
+	else
+		git clean -q -fdx
+	fi
+}
+
+# Most strategies take well under a second, so use a clock with sub-second
+# resolution if date(1) has one (GNU date does, older FreeBSD date doesn't).
+case $(date +%N) in
+*[!0-9]* | "") CLOCK_FORMAT=%s ;;
+*) CLOCK_FORMAT=%s.%N ;;
+esac
+
+# Run one strategy for applying a patch, and log how long it took, so that we
+# can see what each one costs.  cfbot_patch.py picks these lines up.
+timed() {
+	STRATEGY=$1
+	shift
+	START=$(date +$CLOCK_FORMAT)
+	if "$@"; then
+		RESULT=ok
+	else
+		RESULT=failed
+	fi
+	ELAPSED=$(awk -v start="$START" -v end="$(date +$CLOCK_FORMAT)" \
+		'BEGIN { printf "%.3f", end - start }')
+	echo "=== timing: $STRATEGY: $RESULT ${ELAPSED}s ==="
+	[ $RESULT = ok ]
+}
+
+apply_with_patch() {
+	$PATCH_CMD -p1 --no-backup-if-mismatch -V none -f -N <"$1" && git add .
+}
+
+for f in $(cat /work/patch-list); do
 	# This extracts the information from the patch, just like how "git am" would
 	# do it. But because not all patches are created with "git format-patch" this
 	# information, we need to do this manually and fallback to sensible defaults.
@@ -61,26 +146,36 @@ for f in $(cd /work/patches && find . -name '*.patch' -o -name '*.diff' | sort);
 
 }${MESSAGE}"
 
+	PATHS=$(patch_paths "/work/patches/$f")
+	DIRS=$(echo "$PATHS" | sed -e 's,[^/]*$,,' -e 's,^$,.,' | sort -u)
+
 	set +x
-	echo "=== using 'git am' to apply patch $f ==="
-	# git am usually does a decent job at applying a patch, as long as the
-	# patch was created with git format-patch. It also atuomatically creates a
-	# git commit, so we don't need to do that manually and can just continue
-	# with the next patch if it succeeds.
-	git am --3way "/work/patches/$f" && continue
-	# Okay it failed, let's clean up and try the next option.
-	git am --abort
-	git clean -fdx
-	echo "=== using patch(1) to apply patch $f ==="
-	if ! ($PATCH_CMD -p1 --no-backup-if-mismatch -V none -f -N <"/work/patches/$f" && git add .); then
-		git reset HEAD .
-		git checkout -- .
-		git clean -fdx
-		# We use git apply as a last option, because it provides the best
-		# output for conflicts. It also works well for patches that were
-		# already applied.
-		echo "=== using 'git apply' to apply patch $f ==="
-		git apply --3way --allow-empty "/work/patches/$f" || { git diff && exit 1; }
+	if [ -z "$NAME" ] && git apply --check "/work/patches/$f" 2>/dev/null; then
+		# A plain diff that applies cleanly can go straight into the index.
+		# "git am" would only fail on it, because it isn't a mail.
+		echo "=== using 'git apply --index' to apply patch $f ==="
+		timed "git apply --index" git apply --index "/work/patches/$f"
+	else
+		if [ -n "$NAME" ]; then
+			echo "=== using 'git am' to apply patch $f ==="
+			# git am usually does a decent job at applying a patch, as long as the
+			# patch was created with git format-patch. It also atuomatically creates a
+			# git commit, so we don't need to do that manually and can just continue
+			# with the next patch if it succeeds.
+			timed "git am" git am --3way "/work/patches/$f" && continue
+			# Okay it failed, let's clean up and try the next option.
+			git am --abort
+			undo
+		fi
+		echo "=== using patch(1) to apply patch $f ==="
+		if ! timed "patch" apply_with_patch "/work/patches/$f"; then
+			undo
+			# We use git apply as a last option, because it provides the best
+			# output for conflicts. It also works well for patches that were
+			# already applied.
+			echo "=== using 'git apply' to apply patch $f ==="
+			timed "git apply --3way" git apply --3way --allow-empty "/work/patches/$f" || { git diff && exit 1; }
+		fi
 	fi
 
 	if git diff --cached --quiet; then
@@ -1,5 +1,6 @@
 import cfbot_github
 import cfbot_config
+import cfbot_scheduler
 import cfbot_util
 import logging
 import secrets
@@ -147,6 +148,7 @@ def rerun_patch():
            WHERE commitfest_id = %s AND submission_id = %s""",
         (commitfest_id, submission_id),
     )
+    cfbot_scheduler.update_due_times(cursor, commitfest_id, submission_id)
     conn.commit()
 
     return jsonify({"status": "success"})
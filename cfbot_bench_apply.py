@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#
+# Measure how long it takes to apply a corpus of patch sets, using the same
+# patchburner create/apply/destroy steps as cfbot_patch.py, so that changes to
+# the apply pipeline can be compared.  Run it from the cfbot directory (it
+# needs cfbot_config.py and an initialized template repo), giving a directory
+# that holds one subdirectory per patch set, and the master commit to apply
+# them to:
+#
+#   ./cfbot_bench_apply.py corpus/ <commit> [runs] [slot]
+#
+# Each patch set's files are copied into the burner as they are, so they can
+# be anything that apply-patches.sh understands: git format-patch series,
+# plain diffs, .gz, .tar.gz and .zip archives.  Nothing is fetched from the
+# network, but the template repo's master branch is moved to the given commit
+# (cfbot_patch.py moves it back when it next creates a burner).
+#
+# For each patch set it reports the apply script's exit code and the best
+# time taken by each stage, including each strategy that apply-patches.sh
+# tried, and finally the median of each stage and the throughput.
+
+import cfbot_git
+import cfbot_patch
+import cfbot_util
+import os
+import statistics
+import sys
+import time
+
+
+def apply_patch_set(path, base_commit_id, slot):
+    """Apply the patches in a directory in a fresh burner, and return the
+    apply script's exit code and a StageTimer."""
+    timer = cfbot_patch.StageTimer()
+    template_repo_path = cfbot_patch.patchburner_ctl("template-repo-path").strip()
+    with timer.stage("create"):
+        with cfbot_util.lock("template"):
+            cfbot_patch.switch_to_commit(template_repo_path, base_commit_id)
+            cfbot_patch.patchburner_ctl("destroy", slot)
+            cfbot_patch.patchburner_ctl("create", slot)
+    burner_repo_path = cfbot_patch.patchburner_ctl("burner-repo-path", slot).strip()
+    patch_dir = cfbot_patch.patchburner_ctl("burner-patch-path", slot).strip()
+    for filename in sorted(os.listdir(path)):
+        with open(os.path.join(path, filename), "rb") as f:
+            content = f.read()
+        with open(os.path.join(patch_dir, filename), "wb") as f:
+            f.write(content)
+    cfbot_patch.make_branch(burner_repo_path, "bench")
+    with timer.stage("apply"):
+        output, rcode = cfbot_patch.patchburner_ctl("apply", slot, want_rcode=True)
+    for strategy, result, seconds in cfbot_patch.RE_APPLY_TIMING.findall(output):
+        timer.add(f"apply: {strategy} ({result})", float(seconds))
+    with timer.stage("destroy"):
+        cfbot_patch.patchburner_ctl("destroy", slot)
+    return rcode, timer
+
+
+def main(corpus, base_commit_id, runs, slot):
+    patch_sets = sorted(
+        name for name in os.listdir(corpus) if os.path.isdir(os.path.join(corpus, name))
+    )
+    template_repo_path = cfbot_patch.patchburner_ctl("template-repo-path").strip()
+    base_commit_id = cfbot_git.rev_parse(template_repo_path, base_commit_id)
+    stage_times = {}
+    start = time.monotonic()
+    with cfbot_util.lock("burner-%d" % slot):
+        # the slot's ready burner, if any, is about to be destroyed
+        try:
+            os.unlink(cfbot_patch.burner_ready_path(slot))
+        except FileNotFoundError:
+            pass
+        for name in patch_sets:
+            best = {}
+            for _ in range(runs):
+                rcode, timer = apply_patch_set(
+                    os.path.join(corpus, name), base_commit_id, slot
+                )
+                for stage, elapsed in timer.stages.items():
+                    best[stage] = min(best.get(stage, elapsed), elapsed)
+            print("%-40s rcode=%d" % (name, rcode))
+            for stage, elapsed in best.items():
+                print("    %-32s %8.2f s" % (stage, elapsed))
+                stage_times.setdefault(stage, []).append(elapsed)
+    elapsed = time.monotonic() - start
+    print()
+    for stage, times in stage_times.items():
+        print(
+            "%-36s %8.2f s median over %d"
+            % (stage, statistics.median(times), len(times))
+        )
+    print(
+        "%d patch sets in %.1f s, %.1f per minute"
+        % (
+            len(patch_sets) * runs,
+            elapsed,
+            len(patch_sets) * runs * 60 / elapsed,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main(
+        sys.argv[1],
+        sys.argv[2],
+        int(sys.argv[3]) if len(sys.argv) > 3 else 1,
+        int(sys.argv[4]) if len(sys.argv) > 4 else 0,
+    )
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# Measure how long it takes to import each of our entry points, using
+# "python -X importtime", so that we can notice when something slow creeps
+# into the import graph.  Run it from the cfbot directory (it needs
+# cfbot_config.py), optionally giving the number of runs to take the best of:
+#
+#   ./cfbot_bench_startup.py [runs]
+#
+# For each entry point it reports the total import time and the modules it
+# imports directly that contributed the most to it.
+
+import subprocess
+import sys
+
+# cfbot_api.py is not included, because it connects to the database at import
+# time.
+ENTRY_POINTS = (
+    "cfbot_periodic_minutely",
+    "cfbot_periodic_hourly",
+    "cfbot_periodic_daily",
+    "cfbot_periodic_daemon",
+    "cfbot_patch",
+    "cfbot_work_queue",
+    "cfbot_web_statistics",
+)
+
+# how many of the slowest imports to show for each entry point
+TOP = 5
+
+
+def import_times(module):
+    """Import a module in a fresh interpreter, and return its total import time
+    in microseconds, and a dictionary of the cumulative import times of the
+    modules that it imported directly."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        check=True,
+    )
+    total = None
+    children = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if not fields[1].strip().isdigit():
+            continue  # header
+        cumulative = int(fields[1])
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == module:
+                total = cumulative
+                break
+            # something imported at interpreter startup, not by us
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = cumulative
+    return total, children
+
+
+def main(runs):
+    for module in ENTRY_POINTS:
+        best = None
+        for _ in range(runs):
+            total, children = import_times(module)
+            if best is None or total < best[0]:
+                best = total, children
+        total, children = best
+        print("%-28s %8.1f ms" % (module, total / 1000))
+        slowest = sorted(((t, name) for name, t in children.items()), reverse=True)
+        for t, name in slowest[:TOP]:
+            print("    %-24s %8.1f ms" % (name, t / 1000))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import cfbot_config
+import cfbot_scheduler
 import cfbot_util
 import cfbot_work_queue
 
@@ -250,6 +251,8 @@ def compute_submission_backoff(cursor, commitfest_id, submission_id, build_statu
             backoff,
         )
 
+    cfbot_scheduler.update_due_times(cursor, commitfest_id, submission_id)
+
 
 # We track the "current" build for each cfbot-managed branch.  The current
 # branch is the one that is still in progress, or otherwise the latest one.
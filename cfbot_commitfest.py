@@ -6,8 +6,10 @@
 
 import cfbot_commitfest_rpc
 import cfbot_config
+import cfbot_scheduler
 import cfbot_util
 import json
+import time
 
 import logging
 
@@ -16,7 +18,13 @@ import logging
 IGNORE_TASK_NAMES = ("Cancel previous runs", "Determine enabled OSes")
 
 
-def pull_submissions(conn, commitfest_id):
+def out_of_time(deadline):
+    """Have we used up the time budget given to us by our caller?  The
+    deadline is a time.monotonic() value, or None for no limit."""
+    return deadline is not None and time.monotonic() > deadline
+
+
+def pull_submissions(conn, commitfest_id, deadline=None):
     """Fetch the list of submissions and make sure we have a row for each one.
     Update the last email time according to the Commitfest main page,
     as well as name, status, authors in case they changed."""
@@ -24,6 +32,12 @@ def pull_submissions(conn, commitfest_id):
     for submission in cfbot_commitfest_rpc.get_submissions_for_commitfest(
         commitfest_id
     ):
+        if out_of_time(deadline):
+            logging.info(
+                "ran out of time pulling submissions for commitfest %s, will continue next time",
+                commitfest_id,
+            )
+            break
         # avoid writing for nothing by doing a read query first
         cursor.execute(
             """SELECT *
@@ -71,13 +85,93 @@ def pull_submissions(conn, commitfest_id):
                 submission.last_email_time,
             ),
         )
+        cfbot_scheduler.update_due_times(cursor, commitfest_id, submission.id)
         conn.commit()
 
 
-def pull_modified_threads(conn):
+def pull_thread_messages(conn, thread_url):
+    """Bring our copy of a thread up to date.  We remember every message we've
+    seen along with the attachments we found in it, so we only need to parse
+    the messages that arrived after our high-water mark.  Return the set of
+    IDs of all the messages that the archives showed this time."""
+    cursor = conn.cursor()
+    # serialize concurrent pulls of the same thread
+    cursor.execute("""SELECT pg_advisory_xact_lock(hashtext(%s))""", (thread_url,))
+    cursor.execute(
+        """SELECT message_id, position
+                      FROM thread_message
+                     WHERE thread_url = %s
+                  ORDER BY position DESC
+                     LIMIT 1""",
+        (thread_url,),
+    )
+    if row := cursor.fetchone():
+        last_message_id, position = row
+    else:
+        last_message_id, position = None, 0
+    messages, message_ids = cfbot_commitfest_rpc.get_thread_messages(
+        thread_url, last_message_id
+    )
+    for message_id, attachments in messages:
+        position += 1
+        cursor.execute(
+            """INSERT INTO thread_message (thread_url, message_id, position,
+                                              attachments, received)
+                      VALUES (%s, %s, %s, %s::text[], now())
+                 ON CONFLICT DO NOTHING""",
+            (thread_url, message_id, position, attachments),
+        )
+    conn.commit()
+    return message_ids
+
+
+def wait_for_message(conn, thread_url, message_id, timeout):
+    """Pull a thread until it contains message_id, polling with exponential
+    backoff for up to timeout seconds, because the archives are sometimes slow
+    to show new messages in the flat thread.  We check the page we just
+    fetched, not our copy of the thread, which may already have the message
+    from an earlier pull.  Return True if it turned up, or if we weren't
+    expecting any particular message."""
+    deadline = time.monotonic() + timeout
+    delay = 0.5
+    while True:
+        message_ids = pull_thread_messages(conn, thread_url)
+        if message_id is None or message_id in message_ids:
+            return True
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+        delay *= 2
+
+
+def get_latest_patches(conn, thread_url, pull=True):
+    """Find the last message in a thread that had at least one attachment that
+    looks like a patch.  Return the message ID and the list of URLs to fetch
+    all the patches.  If pull is False, the caller has only just brought our
+    copy of the thread up to date."""
+    if pull:
+        pull_thread_messages(conn, thread_url)
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT message_id, attachments
+                      FROM thread_message
+                     WHERE thread_url = %s
+                       AND cardinality(attachments) > 0
+                  ORDER BY position DESC
+                     LIMIT 1""",
+        (thread_url,),
+    )
+    if row := cursor.fetchone():
+        message_id, attachments = row
+        return cfbot_commitfest_rpc.select_patches(message_id, attachments)
+    return None, []
+
+
+def pull_modified_threads(conn, deadline=None):
     """Check all threads we've never checked before, or whose last_email_time
     has moved.  We want to find the lastest message ID that has attachments
-    that we understand, and remember that."""
+    that we understand, and remember that.  Stop early if we run past the
+    deadline; the rest will be picked up next time."""
     cursor = conn.cursor()
     cursor2 = conn.cursor()
     # don't look at threads that have changed in the last minute, because the
@@ -89,6 +183,9 @@ def pull_modified_threads(conn):
                         OR (last_email_time_checked != last_email_time AND
                             last_email_time < now() - interval '1 minutes')""")
     for commitfest_id, submission_id, last_email_time in cursor:
+        if out_of_time(deadline):
+            logging.info("ran out of time checking threads, will continue next time")
+            break
         logging.info(
             "checking commitfest %s submission %s" % (commitfest_id, submission_id)
         )
@@ -98,9 +195,7 @@ def pull_modified_threads(conn):
         if url is None:
             message_id = None
         else:
-            message_id, attachments = (
-                cfbot_commitfest_rpc.get_latest_patches_from_thread_url(url)
-            )
+            message_id, attachments = get_latest_patches(conn, url)
         cursor2.execute(
             """UPDATE submission
                           SET last_email_time_checked = %s,
@@ -110,6 +205,7 @@ def pull_modified_threads(conn):
                           AND submission_id = %s""",
             (last_email_time, message_id, commitfest_id, submission_id),
         )
+        cfbot_scheduler.update_due_times(cursor2, commitfest_id, submission_id)
         conn.commit()
 
 
@@ -41,15 +41,33 @@ def url_looks_like_patch_tarball(url):
     )
 
 
-def get_latest_patches_from_thread_url(thread_url):
-    """Given a 'whole thread' URL from the archives, find the last message that
-    had at least one attachment called something.patch.  Return the message
-    ID and the list of URLs to fetch all the patches."""
-    selected_message_attachments = []
-    selected_message_id = None
-    message_attachments = []
-    message_id = None
-    for line in cfbot_util.slow_fetch(thread_url).splitlines():
+RE_MESSAGE_LINK = re.compile('<td><a href="/message-id/[^"]+">([^"]+)</a></td>')
+
+
+def parse_thread_messages(lines, after_message_id=None):
+    """Parse the lines of a 'whole thread' page from the archives, and return
+    a list of (message ID, attachment URLs) pairs in thread order, keeping only
+    the attachments that look like patches or tarballs.  If after_message_id
+    is given, only the messages that follow it are parsed, and None is
+    returned if it doesn't appear at all."""
+    messages = []
+    message_attachments = None
+    skipping = after_message_id is not None
+    for line in lines:
+        # start of a new message?
+        groups = RE_MESSAGE_LINK.search(line)
+        if groups:
+            message_id = groups.group(1)
+            if skipping:
+                if message_id == after_message_id:
+                    skipping = False
+                continue
+            message_attachments = []
+            messages.append((message_id, message_attachments))
+            continue
+
+        if message_attachments is None:
+            continue
         groups = re.search(
             '<a href="(/message-id/attachment/[^"]*)">',
             line,
@@ -59,48 +77,62 @@ def get_latest_patches_from_thread_url(thread_url):
             url = "https://www.postgres.org" + attachment
             if url_looks_like_patch(url) or url_looks_like_patch_tarball(url):
                 message_attachments.append(url)
-                selected_message_attachments = message_attachments
-                selected_message_id = message_id
 
-        # start of a new message?
-        groups = re.search('<td><a href="/message-id/[^"]+">([^"]+)</a></td>', line)
-        if groups:
-            message_id = groups.group(1)
-            message_attachments = []
-
-    if selected_message_attachments is not None:
-        if any(
-            url_looks_like_patch_tarball(url) for url in selected_message_attachments
-        ):
-            # there is a tarball.  we don't actually know if it contains any
-            # patches (rather than, say, benchmark results).  this is stupid,
-            # but we'll try to guess...
-            #
-            # XXX the basic problem here is that we can't peek into the
-            # tarballs and see if they contain patches, which is a bit sad;
-            # perhaps we should just take everything, and teach the patch
-            # burner script to examine everything and fail with a special
-            # result code for 'nothing to do here' if it can't find any
-            # patches?  the point of that would be to avoid running any code
-            # that downloads and unpacks stuff outside the container, since we
-            # don't really have enough information here but also don't want to
-            # touch untrusted data here
-            if any(url_looks_like_patch(url) for url in selected_message_attachments):
-                # mixture of tarballs and patches, keep only the patches (not
-                # great as it would be nice to be able to post a tarball + an
-                # extra plain patch)
-                selected_message_attachments = list(
-                    filter(url_looks_like_patch, selected_message_attachments)
-                )
-            elif len(selected_message_attachments) > 1:
-                # tarball-only, multi-tarball messages not currently supported
-                selected_message_id = None
-                selected_message_attachments = None
+    if skipping:
+        return None
+    return messages
+
+
+def parse_message_ids(lines):
+    """Return the set of message IDs that appear on a 'whole thread' page."""
+    return {
+        groups.group(1) for line in lines if (groups := RE_MESSAGE_LINK.search(line))
+    }
+
+
+def get_thread_messages(thread_url, after_message_id=None):
+    """Given a 'whole thread' URL from the archives, return the messages that
+    follow after_message_id (or all of them, if it is None or can't be found
+    in the thread any more), as parsed by parse_thread_messages(), and the set
+    of IDs of all the messages that the page showed."""
+    lines = cfbot_util.slow_fetch(thread_url).splitlines()
+    messages = parse_thread_messages(lines, after_message_id)
+    if messages is None:
+        messages = parse_thread_messages(lines)
+    return messages, parse_message_ids(lines)
+
+
+def select_patches(message_id, attachments):
+    """Given a message ID and the list of attachment URLs found in it, decide
+    which of them we'll try to apply.  Return the message ID and the list of
+    URLs to fetch."""
+    if any(url_looks_like_patch_tarball(url) for url in attachments):
+        # there is a tarball.  we don't actually know if it contains any
+        # patches (rather than, say, benchmark results), and we don't want to
+        # unpack untrusted data outside the patch burner to find out, so we
+        # take all of the tarballs and the patch burner script tells us if
+        # there was nothing to do here
+        if any(url_looks_like_patch(url) for url in attachments):
+            # mixture of tarballs and patches, keep only the patches (not
+            # great as it would be nice to be able to post a tarball + an
+            # extra plain patch)
+            attachments = list(filter(url_looks_like_patch, attachments))
 
     # if there are multiple patch files, they had better follow the convention
     # of leading numbers, otherwise we don't know how to apply them in the right
     # order
-    return selected_message_id, selected_message_attachments
+    return message_id, attachments
+
+
+def get_latest_patches_from_thread_url(thread_url):
+    """Given a 'whole thread' URL from the archives, find the last message that
+    had at least one attachment called something.patch.  Return the message
+    ID and the list of URLs to fetch all the patches."""
+    messages, _ = get_thread_messages(thread_url)
+    for message_id, attachments in reversed(messages):
+        if attachments:
+            return select_patches(message_id, attachments)
+    return None, []
 
 
 def get_thread_url_for_submission(commitfest_id, submission_id):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import cfbot_config
+import cfbot_patch
 import cfbot_util
 import logging
 
@@ -144,6 +145,52 @@ def gc(conn):
     )
     conn.commit()
 
+    # Trim threads that haven't had any new messages for a long time.
+    cursor.execute(
+        """
+  delete from thread_message
+   where thread_url in (select thread_url
+                          from thread_message
+                         group by thread_url
+                        having max(received) < now() - interval '1 day' * %s)""",
+        (cfbot_config.RETENTION_ALL,),
+    )
+    logging.info(
+        "garbage collected %d messages from threads idle for more than %d days",
+        cursor.rowcount,
+        cfbot_config.RETENTION_ALL,
+    )
+    conn.commit()
+
+    # Trim apply results for master commits that we no longer apply patches
+    # to (the template base can lag behind the good master commit for a
+    # while), and the refs that keep their commits alive in the template repo.
+    cursor.execute(
+        """
+  delete from apply_cache
+   where base_commit_id <> all(%s::text[])
+returning base_commit_id, patch_hash, commit_id""",
+        (
+            [
+                commit_id
+                for commit_id in (
+                    cfbot_patch.good_master_commit(conn),
+                    cfbot_patch.template_base_commit(),
+                )
+                if commit_id
+            ],
+        ),
+    )
+    refs = [
+        cfbot_patch.applied_ref(base_commit_id, patch_hash)
+        for base_commit_id, patch_hash, commit_id in cursor.fetchall()
+        if commit_id
+    ]
+    if refs:
+        cfbot_patch.delete_applied_refs(refs)
+    logging.info("garbage collected %d apply cache entries", cursor.rowcount)
+    conn.commit()
+
 
 if __name__ == "__main__":
     with cfbot_util.db() as conn:
@@ -0,0 +1,85 @@
+# Helpers for running git commands without going through a shell, so that
+# each one costs a single process, and a long-running "git cat-file" process
+# for looking up objects in repos that stick around.
+
+import os
+import subprocess
+import threading
+
+
+def git(repo_path, *args, check=True, **kwargs):
+    """Run a git command in a repo, and return its standard output."""
+    return subprocess.run(
+        ["git", *args],
+        cwd=repo_path,
+        check=check,
+        stdout=subprocess.PIPE,
+        encoding="utf-8",
+        **kwargs,
+    ).stdout
+
+
+def rev_parse(repo_path, rev):
+    """Return the object ID that a revision names."""
+    return git(repo_path, "rev-parse", "--verify", rev).strip()
+
+
+def rev_list(repo_path, *args):
+    """Return the list of commit IDs that "git rev-list" outputs."""
+    return git(repo_path, "rev-list", *args).split()
+
+
+class CatFile:
+    """A "git cat-file --batch-check" process that answers questions about
+    objects in a repo, without starting a new process for each one."""
+
+    def __init__(self, repo_path):
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch-check"],
+            cwd=repo_path,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            encoding="utf-8",
+        )
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def info(self, rev):
+        """Return the object ID, type and size of the object that a revision
+        names, or None if there is no such object."""
+        with self.lock:
+            self.process.stdin.write(rev + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        fields = line.split()
+        if len(fields) != 3:
+            # "<rev> missing", or "<rev> ambiguous"
+            return None
+        object_id, type, size = fields
+        return object_id, type, int(size)
+
+
+cat_files = {}
+cat_files_lock = threading.Lock()
+
+
+def cat_file(repo_path):
+    """Return a shared CatFile for a repo.  This is only for repos that live as
+    long as we do, like the template repo, not for burners, which are
+    destroyed and created again under the same path."""
+    repo_path = os.path.abspath(repo_path)
+    with cat_files_lock:
+        entry = cat_files.get(repo_path)
+        if entry is None or not entry.alive():
+            entry = cat_files[repo_path] = CatFile(repo_path)
+        return entry
+
+
+def object_id(repo_path, rev):
+    """Return the object ID that a revision names in a long-lived repo, or
+    None if there is no such object."""
+    if info := cat_file(repo_path).info(rev):
+        return info[0]
+    return None
@@ -52,6 +52,7 @@
 # resolve violations?
 
 import cfbot_config
+import cfbot_scheduler
 import cfbot_util
 import cfbot_work_queue
 
@@ -200,6 +201,8 @@ def compute_submission_backoff(cursor, commitfest_id, submission_id, build_statu
             backoff,
         )
 
+    cfbot_scheduler.update_due_times(cursor, commitfest_id, submission_id)
+
 
 # We track the "current" build for each cfbot-managed branch.  The current
 # branch is the one that is still in progress, or otherwise the latest one.
@@ -396,6 +399,12 @@ def ingest_build(conn, build_id, commit_id, branch_name, build_status, source):
     )
     update_branch(cursor, build_id, build_status, commit_id, branch_name)
 
+    # a new good master commit brings bitrot checks forward for submissions
+    # whose files it changed, and becomes the base for new burners
+    if branch_name == "master" and build_status == "COMPLETED":
+        cfbot_scheduler.update_due_times(cursor)
+        cfbot_work_queue.insert_work_queue_if_not_exists(cursor, "fetch-template-base")
+
 
 def ingest_task(conn, build_id, task_id, task_status, task_name, source):
     repo, run_id, run_attempt = split_build_id(build_id)
@@ -769,13 +778,13 @@ def refresh_build_status_statistics(conn):
 
 
 def gc_remote_branches(conn):
-    # This horrible big lock prevents branches from being created or deleted
-    # while we are paginating through them...
+    # This lock prevents branches from being created or deleted while we are
+    # paginating through them...
     #
     # XXX Could do better than this... one problem is that we only create
     # branch records after pushing, creating a window for deleting a branch
     # we'd just pushed...
-    with cfbot_util.lock():
+    with cfbot_util.lock("push"):
         # File the branches that still have build records
         cursor = conn.cursor()
 
@@ -906,6 +915,31 @@ def handle_push_webhook(conn, event):
     logging.info("will mirror repo %s branch %s", repo, branch)
     cfbot_work_queue.insert_work_queue(cursor, "push-mirror-branch", branch)
 
+    if branch == "master":
+        # Note which submissions touch the same files as the new commits, so
+        # that they can be checked for conflicts sooner.
+        #
+        # XXX GitHub only includes the first 20 commits of a push in the
+        # event, so we miss files changed by any more than that.
+        paths = set()
+        for commit in event.get("commits", []):
+            for key in ("added", "modified", "removed"):
+                paths.update(commit.get(key, []))
+        if paths:
+            cursor.execute(
+                """UPDATE submission s
+                      SET last_overlap_time = now()
+                    WHERE EXISTS (SELECT 1
+                                    FROM submission_file f
+                                   WHERE f.commitfest_id = s.commitfest_id
+                                     AND f.submission_id = s.submission_id
+                                     AND f.path = ANY(%s::text[]))""",
+                (list(paths),),
+            )
+            logging.info(
+                "%d submissions touch files changed on master", cursor.rowcount
+            )
+
 
 # ======================================================================
 # Functions called by cfbot workers servicing work_queue items.
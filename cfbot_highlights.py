@@ -7,7 +7,6 @@ import cfbot_util
 import cfbot_web_highlights
 import cfbot_work_queue
 import re
-import scipy.stats
 import requests
 import time
 import logging
@@ -401,6 +400,9 @@ def fetch_task_artifacts(conn, task_id):
 
 
 def analyze_task_tests(conn, task_id):
+    # scipy is slow to import, and this is the only place that needs it
+    import scipy.stats
+
     cursor = conn.cursor()
     cursor.execute("""select submission_id from task where task_id = %s""", (task_id,))
     (submission_id,) = cursor.fetchone()
@@ -449,4 +451,5 @@ select task.task_name,
 
 def refresh_highlight_pages(conn, type):
     # rebuild pages of the requested type/mode
-    cfbot_web_highlights.rebuild_type(conn, type)
+    with cfbot_util.lock("web"):
+        cfbot_web_highlights.rebuild_type(conn, type)
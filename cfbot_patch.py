@@ -1,28 +1,30 @@
 #!/usr/bin/env python3
 #
-# Figure out which submission most needs to be pushed into a new branch for
-# building and testing.  Goals:
+# Push submissions into new branches for building and testing.  Goals:
 #
 # 1.  Don't do anything if we're still waiting for build results from too
 #     many branches from any given provider.  This limits our resource
 #     consumption.
-# 2.  The top priority is noticing newly posted patches.  So find the least
-#     recent submission whose last message ID has changed since our last
-#     branch.
-# 3.  If we can't find any of those, then just rebuild every patch at a rate
-#     that will get though them all every 48 hours, to check for bitrot.
+# 2.  Otherwise, take the submissions that cfbot_scheduler.py says are due,
+#     and apply their patches.
 
+import cfbot_commitfest
 import cfbot_commitfest_rpc
 import cfbot_config
+import cfbot_git
+import cfbot_scheduler
 import cfbot_util
 import cfbot_work_queue
+import concurrent.futures
+import contextlib
+import hashlib
 import logging
 import os
 import re
 import requests
 import shlex
 import subprocess
-import tempfile
+import threading
 import time
 import sys
 from urllib.parse import urlparse
@@ -61,164 +63,108 @@ def capture(command, *args, stdout=subprocess.PIPE, encoding="utf-8", **kwargs):
     return run(command, *args, stdout=stdout, encoding=encoding, **kwargs).stdout
 
 
-def need_to_limit_rate(conn):
-    """Have we pushed too many branches recently?"""
-    # Don't let any provider finish up with more than the configured maximum
-    # number of builds still running.
-    cursor = conn.cursor()
-    cursor.execute("""SELECT COUNT(*)
-                      FROM branch
-                     WHERE status = 'testing'""")
-    row = cursor.fetchone()
-    return row and row[0] >= cfbot_config.CONCURRENT_BUILDS
-
-
-def choose_submission_with_new_patch(conn, cf_ids):
-    """Return the ID pair for the submission most deserving, because it has been
-    waiting the longest amongst submissions that have a new patch
-    available."""
-    # we'll use the last email time as an approximation of the time the patch
-    # was sent, because it was most likely that message and it seems like a
-    # waste of time to use a more accurate time for the message with the
-    # attachment
-    # -- wait a couple of minutes before probing because the archives are slow!
-    cursor = conn.cursor()
-    cursor.execute(
-        """SELECT commitfest_id, submission_id
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND last_message_id IS DISTINCT FROM last_branch_message_id
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                       AND commitfest_id = ANY(%s)
-                       AND submission_id NOT IN (4431, 4365) -- Joe!
-                  ORDER BY last_email_time
-                     LIMIT 1""",
-        (cf_ids,),
-    )
-    row = cursor.fetchone()
-    if row:
-        return row
-    else:
-        return None, None
-
-
-def choose_submission_without_new_patch(conn, cf_ids):
-    """Return the ID pair for the submission that has been waiting longest for
-    a periodic bitrot check, but only if we're under the configured rate per
-    hour (which is expressed as the cycle time to get through all
-    submissions)."""
-    # how many submissions are there?
+def queue_latency(conn):
+    """Return how long, in seconds, CI tasks have been waiting for a runner
+    recently (the 90th percentile of the time each spent in CREATED and
+    SCHEDULED, counting those that are still waiting), or None if there were
+    none."""
     cursor = conn.cursor()
     cursor.execute(
-        """SELECT COUNT(*)
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND commitfest_id = ANY(%s)
-                       AND (backoff_until IS NULL OR now() >= backoff_until)
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')""",
-        (cf_ids,),
-    )
-    (number,) = cursor.fetchone()
-    # how many will we need to do per hour to approximate our target rate?
-    target_per_hour = number / cfbot_config.CYCLE_TIME
-    # are we currently above or below our target rate?
-    cursor.execute(
-        """SELECT COUNT(*)
-                      FROM submission
-                     WHERE last_message_id IS NOT NULL
-                       AND commitfest_id = ANY(%s)
-                       AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                       AND last_branch_time > now() - INTERVAL '1 hour'""",
-        (cf_ids,),
+        """WITH recent AS (SELECT task_id,
+                                  status,
+                                  received,
+                                  lead(received) OVER (PARTITION BY task_id ORDER BY received) AS next_received
+                             FROM task_status_history
+                            WHERE received > now() - %s::interval),
+                waits AS (SELECT task_id,
+                                 sum(coalesce(next_received, now()) - received) AS wait
+                            FROM recent
+                           WHERE status IN ('CREATED', 'SCHEDULED')
+                        GROUP BY task_id
+                       UNION ALL
+                          -- tasks that have been waiting since before the window
+                          SELECT task_id, now() - modified
+                            FROM task
+                           WHERE task_status_running(status)
+                             AND status IN ('CREATED', 'SCHEDULED')
+                             AND modified <= now() - %s::interval)
+         SELECT percentile_cont(0.9) WITHIN GROUP (ORDER BY extract(epoch FROM wait))
+           FROM waits""",
+        (cfbot_config.QUEUE_LATENCY_WINDOW, cfbot_config.QUEUE_LATENCY_WINDOW),
     )
-    (current_rate_per_hour,) = cursor.fetchone()
-    # is it time yet?
-    if current_rate_per_hour < target_per_hour:
-        cursor.execute(
-            """SELECT commitfest_id, submission_id
-                        FROM submission
-                       WHERE last_message_id IS NOT NULL
-                         AND commitfest_id = ANY(%s)
-                         AND (backoff_until IS NULL OR now() >= backoff_until)
-                         AND status IN ('Ready for Committer', 'Needs review', 'Waiting on Author')
-                         AND submission_id NOT IN (4431, 4365) -- Joe!
-                    ORDER BY last_branch_time NULLS FIRST
-                       LIMIT 1""",
-            (cf_ids,),
-        )
-        row = cursor.fetchone()
-        if row:
-            return row
-        else:
-            return None, None
-    else:
-        return None, None
-
-
-def choose_submission(conn, cf_ids):
-    """Choose the best submission to process, giving preference to new
-    patches."""
-    commitfest_id, submission_id = choose_submission_with_new_patch(conn, cf_ids)
-    if submission_id:
-        return commitfest_id, submission_id
-    commitfest_id, submission_id = choose_submission_without_new_patch(conn, cf_ids)
-    return commitfest_id, submission_id
+    (latency,) = cursor.fetchone()
+    return latency
+
+
+def concurrent_builds_limit(conn):
+    """Decide how many builds we can have running.  If CI tasks are getting
+    runners promptly, we can afford to have more; if they are queuing up,
+    adding more builds would only make the queue longer."""
+    if not cfbot_config.CONCURRENT_BUILDS_MAX:
+        return cfbot_config.CONCURRENT_BUILDS
+    latency = queue_latency(conn)
+    if latency is None:
+        return cfbot_config.CONCURRENT_BUILDS
+    target = cfbot_config.QUEUE_LATENCY_TARGET
+    limit = int(cfbot_config.CONCURRENT_BUILDS_MAX * target / max(latency, target))
+    return max(cfbot_config.CONCURRENT_BUILDS_MIN, limit)
+
+
+def need_to_limit_rate(conn, in_flight=0, limit=None):
+    """Have we pushed too many branches recently?  in_flight is the number of
+    submissions we are already processing, which will soon be builds.  limit
+    is the result of concurrent_builds_limit(), if the caller already has
+    it."""
+    if limit is None:
+        limit = concurrent_builds_limit(conn)
+    # Don't let any provider finish up with more than the configured maximum
+    # number of builds still running.
+    return cfbot_scheduler.in_flight_builds(conn) + in_flight >= limit
 
 
 def checkout_patchbase_branch(repo_dir, branch):
-    """Switch patchbase repo to a given branch."""
-    subprocess.call(
-        "cd %s && git checkout . -q > /dev/null && git clean -fd > /dev/null && git checkout -q %s"
-        % (repo_dir, branch),
-        shell=True,
-    )
+    """Switch patchbase repo to a given branch, discarding any changes."""
+    cfbot_git.git(repo_dir, "checkout", "-q", "-f", branch, check=False)
+    cfbot_git.git(repo_dir, "clean", "-q", "-fd", check=False)
 
 
-def update_patchbase_tree(repo_dir, branch):
-    """Switch branch and pull changes from tracked remote."""
-    checkout_patchbase_branch(repo_dir, branch)
-    subprocess.call(
-        "cd %s && git pull -q" % repo_dir,
-        shell=True,
-    )
+def fetch_upstream(repo_dir, *refs):
+    """Fetch refs from the upstream repo.  This doesn't touch the work tree, so
+    it can run without the template lock, and burners can still be created
+    while we wait for the network."""
+    cfbot_git.git(repo_dir, "fetch", "-q", "origin", *refs, check=False)
 
 
 def get_commit_id(repo_dir):
-    return (
-        subprocess.check_output(
-            "cd %s && git show | head -1 | cut -d' ' -f2" % repo_dir, shell=True
-        )
-        .decode("utf-8")
-        .strip()
-    )
+    return cfbot_git.rev_parse(repo_dir, "HEAD")
 
 
 def reset_commit_id(repo_dir, commit_id):
-    subprocess.call(
-        "cd %s && git checkout . -q > /dev/null && git clean -fd > /dev/null && git checkout -q master && git reset --hard %s -q"
-        % (repo_dir, commit_id),
-        shell=True,
+    """Point master at a given commit, and switch to it."""
+    cfbot_git.git(
+        repo_dir, "checkout", "-q", "-f", "-B", "master", commit_id, check=False
     )
+    cfbot_git.git(repo_dir, "clean", "-q", "-fd", check=False)
+
+
+def switch_to_commit(repo_dir, commit_id):
+    """Switch to master at a given commit, unless we're already there."""
+    # in case something left another branch checked out
+    checkout_patchbase_branch(repo_dir, "master")
+    if cfbot_git.object_id(repo_dir, "HEAD") != commit_id:
+        reset_commit_id(repo_dir, commit_id)
 
 
 def make_branch(burner_repo_path, submission_id):
     branch = f"cf/{submission_id}"
     logging.info("creating branch %s" % branch)
-    # blow away the branch if it exists already
-    subprocess.call(
-        """cd %s && git branch -q -D %s > /dev/null 2> /dev/null"""
-        % (burner_repo_path, branch),
-        shell=True,
-    )  # ignore failure
-    # create a new one
-    subprocess.check_call(
-        """cd %s && git checkout -q -b %s""" % (burner_repo_path, branch), shell=True
-    )
+    # create it, blowing away the branch if it exists already
+    cfbot_git.git(burner_repo_path, "checkout", "-q", "-B", branch)
     return branch
 
 
-def add_merge_commit(
-    conn, burner_repo_path, commitfest_id, submission_id, message_id, version
+def merge_commit_message(
+    conn, commitfest_id, submission_id, message_id, version, directive=None
 ):
     # look up the data we need to make a friendly commit message
     cursor = conn.cursor()
@@ -250,16 +196,51 @@ Author(s): %s
         message_id,
         ", ".join(authors),
     )
-    # commit!
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(commit_message.encode("utf-8"))
-        tmp.flush()
-        current_commit = get_commit_id(burner_repo_path)
-        subprocess.check_call(
-            f"""cd {burner_repo_path} && git reset master --hard -q && git merge -q --no-ff -F {tmp.name} {current_commit}""",
-            shell=True,
-        )
-
+    if directive:
+        commit_message += directive + "\n"
+    return commit_message
+
+
+def commit_merge(
+    conn,
+    repo_path,
+    base_commit,
+    tip_commit,
+    commitfest_id,
+    submission_id,
+    message_id,
+    version,
+    directive=None,
+):
+    """Add a final merge commit with some metadata on top of the commits that
+    the patches were applied as, and return its commit ID.  The tip is based
+    on master, so the merge's tree is the tip's tree, and we don't need a
+    working tree to make it."""
+    commit_message = merge_commit_message(
+        conn, commitfest_id, submission_id, message_id, version, directive
+    )
+    return capture(
+        [
+            "git",
+            "commit-tree",
+            tip_commit + "^{tree}",
+            "-p",
+            base_commit,
+            "-p",
+            tip_commit,
+        ],
+        cwd=repo_path,
+        input=commit_message,
+    ).strip()
+
+
+# apply-patches.sh logs how long each strategy for applying a patch took
+RE_APPLY_TIMING = re.compile(
+    r"^=== timing: (.+): (ok|failed) (\d+(?:\.\d+)?)s ===$", re.MULTILINE
+)
+
+# apply-patches.sh exits with this when it found no patches to apply
+NO_PATCHES_RCODE = 10
 
 RE_ADDITIONS = re.compile(r"(\d+) insertion")
 RE_DELETIONS = re.compile(r"(\d+) deletion")
@@ -283,12 +264,12 @@ def git_shortstat(path, commit):
     return additions, deletions
 
 
-def patchburner_ctl(command, want_rcode=False):
-    """Invoke the patchburner control script."""
+def patchburner_ctl(command, slot=0, want_rcode=False):
+    """Invoke the patchburner control script, for the given burner slot."""
+    args = shlex.split(cfbot_config.PATCHBURNER_CTL) + [command, str(slot)]
     if want_rcode:
         p = subprocess.Popen(
-            """%s %s""" % (cfbot_config.PATCHBURNER_CTL, command),
-            shell=True,
+            args,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
@@ -296,9 +277,22 @@ def patchburner_ctl(command, want_rcode=False):
         rcode = p.wait()
         return output, rcode
     else:
-        return subprocess.check_output(
-            "%s %s" % (cfbot_config.PATCHBURNER_CTL, command), shell=True
-        ).decode("utf-8")
+        return subprocess.check_output(args).decode("utf-8")
+
+
+def update_submission_files(conn, commitfest_id, submission_id, paths):
+    """Remember which files a submission's patches modify."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """DELETE FROM submission_file
+                     WHERE commitfest_id = %s AND submission_id = %s""",
+        (commitfest_id, submission_id),
+    )
+    cursor.execute(
+        """INSERT INTO submission_file (commitfest_id, submission_id, path)
+                    SELECT %s, %s, unnest(%s::text[])""",
+        (commitfest_id, submission_id, paths),
+    )
 
 
 def update_submission(conn, message_id, commit_id, commitfest_id, submission_id):
@@ -317,53 +311,67 @@ def update_submission(conn, message_id, commit_id, commitfest_id, submission_id)
                      WHERE commitfest_id = %s AND submission_id = %s""",
         (message_id, message_id, commit_id, commitfest_id, submission_id),
     )
+    cfbot_scheduler.update_due_times(cursor, commitfest_id, submission_id)
 
 
-def mirror_branch(branch):
+def mirror_branch(conn, branch):
     template_repo_path = patchburner_ctl("template-repo-path").strip()
 
-    # Everything else in this file assumes that
-    # cfbot_periodic_minutely.py acquired the "big lock" while
-    # applying patches etc, but this function is reached by cfbot
-    # workers, and needs interlocking so it does that explicitly here.
-    with cfbot_util.lock():
-        logging.info("updating branch %s in template repo", branch)
-        update_patchbase_tree(template_repo_path, branch)
-        if cfbot_config.GIT_REMOTE_NAME:
+    # This is reached by cfbot workers, concurrently with burners being
+    # created from the template repo.  We push the remote-tracking branch
+    # rather than checking it out, so we don't need the template lock.
+    logging.info("updating branch %s in template repo", branch)
+    fetch_upstream(template_repo_path, branch)
+    if cfbot_config.GIT_REMOTE_NAME:
+        with cfbot_util.lock("push"):
             logging.info("pushing branch %s (automatic mirror)", branch)
             my_env = os.environ.copy()
             my_env["GIT_SSH_COMMAND"] = cfbot_config.GIT_SSH_COMMAND
-            subprocess.check_call(
-                "cd %s && git push -q -f %s %s"
-                % (template_repo_path, cfbot_config.GIT_REMOTE_NAME, branch),
+            cfbot_git.git(
+                template_repo_path,
+                "push",
+                "-q",
+                "-f",
+                cfbot_config.GIT_REMOTE_NAME,
+                f"refs/remotes/origin/{branch}:refs/heads/{branch}",
                 env=my_env,
-                shell=True,
                 stderr=subprocess.DEVNULL,
             )
 
+    # the template repo might be able to move to a newer base now
+    if branch == "master":
+        cfbot_work_queue.insert_work_queue_if_not_exists(
+            conn.cursor(), "fetch-template-base"
+        )
+        conn.commit()
+
 
 def delete_branch(branch):
     template_repo_path = patchburner_ctl("template-repo-path").strip()
 
-    # XXX Not sure if we really need this lock since it's entirely operating on
-    # the remote repo...
-    with cfbot_util.lock():
+    # This only operates on the remote repo, but gc_remote_branches() relies
+    # on branches not coming and going while it looks at them.
+    with cfbot_util.lock("push"):
         if cfbot_config.GIT_REMOTE_NAME:
             logging.info("deleting branch %s", branch)
             my_env = os.environ.copy()
             my_env["GIT_SSH_COMMAND"] = cfbot_config.GIT_SSH_COMMAND
-            subprocess.check_call(
-                "cd %s && git push -q --delete %s %s"
-                % (template_repo_path, cfbot_config.GIT_REMOTE_NAME, branch),
+            cfbot_git.git(
+                template_repo_path,
+                "push",
+                "-q",
+                "--delete",
+                cfbot_config.GIT_REMOTE_NAME,
+                branch,
                 env=my_env,
-                shell=True,
                 # stderr=subprocess.DEVNULL,
             )
 
 
-def reset_repo_to_good_master_commit(conn, repo_path):
-    # find the most recent commit ID that succeeded on master (our
-    # mirror of it, in cfbot's repo, for best cache-sharing)
+def good_master_commit(conn):
+    """Return the most recent commit ID that succeeded on master (our mirror
+    of it, in cfbot's repo, for best cache-sharing), or None if there isn't
+    one."""
     cursor = conn.cursor()
     cursor.execute(
         """SELECT commit_id
@@ -378,79 +386,341 @@ def reset_repo_to_good_master_commit(conn, repo_path):
     result = cursor.fetchone()
     if result:
         (good_commit_id,) = result
+        return good_commit_id
     else:
-        good_commit_id = "origin/master"
-    logging.info("selected master commit %s as base", good_commit_id)
+        return None
+
+
+def fetch_good_master_commit(conn, repo_path):
+    """Make sure that the repo has the most recent good master commit, or
+    origin/master if there isn't one, fetching it if necessary, and return its
+    ID.  This only touches the object store and remote-tracking refs."""
+    good_commit_id = good_master_commit(conn)
+    logging.info("selected master commit %s as base", good_commit_id or "origin/master")
+
+    if good_commit_id is None or not cfbot_git.object_id(repo_path, good_commit_id):
+        logging.info("fetching master into template repo")
+        fetch_upstream(repo_path, "master")
+
+    # fails if we still don't have it
+    return cfbot_git.rev_parse(
+        repo_path, (good_commit_id or "origin/master") + "^{commit}"
+    )
 
-    checkout_patchbase_branch(repo_path, "master")
-    commit_id = get_commit_id(repo_path)
 
-    if commit_id != good_commit_id:
-        logging.info("updating template repo")
-        update_patchbase_tree(repo_path, "master")
-        reset_commit_id(repo_path, good_commit_id)
-        commit_id = get_commit_id(repo_path)
-        if good_commit_id != "origin/master":
-            assert commit_id == good_commit_id
+# Burners are created from a base commit that is chosen ahead of time by
+# fetch-template-base jobs, and held by a ref in the template repo.  That way
+# processing a submission never has to wait for network git operations.
+TEMPLATE_BASE_REF = "refs/cfbot/base"
 
+
+def template_base_commit():
+    """Return the master commit that new burners are created from, or None if
+    it hasn't been chosen yet."""
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    return (
+        cfbot_git.git(
+            template_repo_path,
+            "rev-parse",
+            "--verify",
+            "-q",
+            TEMPLATE_BASE_REF,
+            check=False,
+        ).strip()
+        or None
+    )
+
+
+# fetch-template-base
+def update_template_base(conn):
+    """Fetch the latest good master commit into the template repo if we don't
+    have it yet, and make it the base for new burners.  Only the local steps
+    hold the template lock.  Return the new base commit ID."""
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    commit_id = fetch_good_master_commit(conn, template_repo_path)
+    with cfbot_util.lock("template"):
+        switch_to_commit(template_repo_path, commit_id)
+        cfbot_git.git(template_repo_path, "update-ref", TEMPLATE_BASE_REF, commit_id)
+    logging.info("template base is now %s", commit_id)
     return commit_id
 
 
-def process_submission(conn, commitfest_id, submission_id):
-    cursor = conn.cursor()
+def maintain_template():
+    """Repack the template repo's objects, which the burners borrow, into one
+    pack, and write a commit-graph, which they also use.  Unreachable objects
+    are only loosened, not deleted, in case a burner still needs them.  This
+    can take minutes, so it doesn't take the template lock: git makes sure
+    that concurrent readers, and burners being cloned, see every object."""
     template_repo_path = patchburner_ctl("template-repo-path").strip()
-    burner_repo_path = patchburner_ctl("burner-repo-path").strip()
-    patch_dir = patchburner_ctl("burner-patch-path").strip()
-    commit_id = reset_repo_to_good_master_commit(conn, template_repo_path)
+    logging.info("repacking template repo")
+    cfbot_git.git(template_repo_path, "repack", "-q", "-A", "-d", "-l")
+    cfbot_git.git(
+        template_repo_path,
+        "commit-graph",
+        "write",
+        "--no-progress",
+        "--reachable",
+        "--changed-paths",
+    )
 
-    logging.info("processing submission %d, %d" % (commitfest_id, submission_id))
-    # create a fresh patchburner jail
-    patchburner_ctl("destroy")
-    patchburner_ctl("create")
 
-    # note the base commit, so we can see which files are changed
-    base_commit = get_commit_id(burner_repo_path)
+# Each slot's burner is created ahead of time, so that submissions don't have
+# to wait for it.  While a burner is fresh and unused, a file next to the
+# slot's lock file holds the master commit it was created from.
+
 
-    # find out where to put the patches so the jail can see them
-    # fetch the patches from the thread and put them in the patchburner's
-    # filesystem
-    time.sleep(10)  # argh, try to close race against slow archives
+def burner_ready_path(slot):
+    return cfbot_util.lock_path("burner-%d" % slot) + "-ready"
 
+
+def ready_burner_commit(slot):
+    """Return the master commit that a slot's burner was created from, or None
+    if it isn't ready for use."""
     try:
-        thread_url = cfbot_commitfest_rpc.get_thread_url_for_submission(
-            commitfest_id, submission_id
-        )
-    except requests.exceptions.HTTPError as e:
-        # We've seen some 404's here, probably due to a previously existing entry
-        # being deleted.
-        if e.response.status_code == 404:
-            thread_url = None
-        else:
-            raise
+        with open(burner_ready_path(slot)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def create_burner(conn, slot):
+    """Create a fresh burner in a slot, from the template reset to its base
+    commit, and return that commit ID."""
+    template_repo_path = patchburner_ctl("template-repo-path", slot).strip()
+
+    if template_base_commit() is None:
+        # no fetch-template-base job has run yet, so we'll have to wait
+        update_template_base(conn)
+
+    # the template only needs to hold still while we make a copy of it
+    with cfbot_util.lock("template"):
+        commit_id = template_base_commit()
+        switch_to_commit(template_repo_path, commit_id)
+        logging.info("creating burner in slot %d from %s", slot, commit_id)
+        patchburner_ctl("destroy", slot)
+        patchburner_ctl("create", slot)
+    return commit_id
 
-    if not thread_url:
-        # CF entry with no thread attached?
-        update_submission(conn, None, None, commitfest_id, submission_id)
-        conn.commit()
-        logging.info("skipping submission %s with no thread" % submission_id)
-        return
-    message_id, patch_urls = cfbot_commitfest_rpc.get_latest_patches_from_thread_url(
-        thread_url
-    )
+
+def take_burner(conn, slot, recycling=None):
+    """Return the base commit of a burner that patches can be applied to,
+    using the slot's ready burner if it was created from the current template
+    base commit, and otherwise creating one now.  If recycling is the future
+    of a refresh_burner() call for this slot, wait for that first."""
+    if recycling:
+        recycling.result()
+    commit_id = ready_burner_commit(slot)
+    if commit_id:
+        # whatever happens next, it won't be fresh any more
+        os.unlink(burner_ready_path(slot))
+        if commit_id == template_base_commit():
+            return commit_id
+    return create_burner(conn, slot)
+
+
+def refresh_burner(slot, connect=cfbot_util.db):
+    """Create the next burner in a slot whose lock we hold, and mark it ready.
+    This is run in the background."""
+    try:
+        with connect() as conn:
+            commit_id = create_burner(conn, slot)
+        with open(burner_ready_path(slot), "w") as f:
+            f.write(commit_id)
+    except Exception:
+        # we'll make one when the slot is next used
+        logging.exception("failed to recycle burner in slot %d", slot)
+
+
+def recycle_burner(slot, lock_fd, connect=cfbot_util.db):
+    """Create the next burner in a slot, and then release the slot by closing
+    lock_fd.  This is run in a background thread."""
+    try:
+        refresh_burner(slot, connect)
+    finally:
+        lock_fd.close()
+
+
+def start_recycle_burner(slot, lock_fd, connect=cfbot_util.db):
+    threading.Thread(
+        target=recycle_burner, args=(slot, lock_fd, connect), name="burner-%d" % slot
+    ).start()
+
+
+def download_patches(patch_urls):
+    """Fetch the patches, and return a list of (filename, content) pairs and
+    the version found in their names, if any."""
+    patches = []
     version = None
     for patch_url in patch_urls:
         parsed = urlparse(patch_url)
         filename = os.path.basename(parsed.path)
         if not version and re.match(r"[vV]\d+-", filename):
             version = filename.split("-")[0]
-        dest = os.path.join(patch_dir, filename)
-        with open(dest, "wb+") as f:
-            f.write(cfbot_util.slow_fetch_binary(patch_url))
-    # we applied the patch; now make it into a branch with a commit on it
-    branch = make_branch(burner_repo_path, submission_id)
-    # apply the patches inside the jail
-    output, rcode = patchburner_ctl("apply", want_rcode=True)
-    # write the patch output to a public log file
+        patches.append((filename, cfbot_util.slow_fetch_binary(patch_url)))
+    return patches, version
+
+
+def hash_patches(patches):
+    """Compute a hash of the names and contents of a set of patch files, which
+    identifies it in the apply cache."""
+    h = hashlib.sha256()
+    for filename, content in sorted(patches):
+        h.update(b"%s\0%d\0" % (filename.encode("utf-8"), len(content)))
+        h.update(content)
+    return h.hexdigest()
+
+
+# Applying the same patches on top of the same master commit always gives the
+# same result, so we remember the outcome in the apply_cache table.  The
+# applied commits (not including the merge commit, which has to be made again
+# each time) are kept alive in the template repo by a ref.
+
+
+def applied_ref(base_commit_id, patch_hash):
+    return f"refs/cfbot/applied/{base_commit_id}/{patch_hash}"
+
+
+def get_apply_cache(conn, base_commit_id, patch_hash):
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT status, commit_id, output, patch_count, first_additions, first_deletions, all_additions, all_deletions
+             FROM apply_cache
+            WHERE base_commit_id = %s AND patch_hash = %s""",
+        (base_commit_id, patch_hash),
+    )
+    return cursor.fetchone()
+
+
+def insert_apply_cache(
+    conn, base_commit_id, patch_hash, status, commit_id, output, stats=None
+):
+    cursor = conn.cursor()
+    cursor.execute(
+        """INSERT INTO apply_cache (base_commit_id, patch_hash, status, commit_id, output, patch_count, first_additions, first_deletions, all_additions, all_deletions, created)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, now())
+           ON CONFLICT DO NOTHING""",
+        (base_commit_id, patch_hash, status, commit_id, output)
+        + (stats or (None, None, None, None, None)),
+    )
+
+
+def save_applied_commits(burner_repo_path, branch, ref):
+    """Copy the commits that the patches were applied as from a burner into
+    the template repo, so that they outlive the burner."""
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    with cfbot_util.lock("template"):
+        run(
+            [
+                "git",
+                "fetch",
+                "-q",
+                os.path.abspath(burner_repo_path),
+                f"+refs/heads/{branch}:{ref}",
+            ],
+            cwd=template_repo_path,
+        )
+
+
+def delete_applied_refs(refs):
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    with cfbot_util.lock("template"):
+        run(
+            ["git", "update-ref", "--stdin"],
+            cwd=template_repo_path,
+            input="".join(f"delete {ref}\n" for ref in refs),
+            encoding="utf-8",
+        )
+
+
+# Branches are pushed to the remote monitored repo in batches, because each
+# push has to pay for a connection and the advertisement of thousands of
+# refs.  A commit waiting to be pushed to branch B is held by a ref
+# refs/cfbot/push/B in the template repo, and a push-branches job pushes all of
+# them at once.
+PUSH_REF_PREFIX = "refs/cfbot/push/"
+
+
+def queue_push(conn, branch, commit_id):
+    """Arrange for a commit in the template repo to be pushed to a branch."""
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    run(
+        ["git", "update-ref", PUSH_REF_PREFIX + branch, commit_id],
+        cwd=template_repo_path,
+    )
+    cfbot_work_queue.insert_work_queue_if_not_exists(conn.cursor(), "push-branches")
+
+
+# push-branches
+def push_branches():
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    with cfbot_util.lock("push"):
+        pending = [
+            line.split(" ", 1)
+            for line in capture(
+                ["git", "for-each-ref", "--format=%(objectname) %(refname)"]
+                + [PUSH_REF_PREFIX],
+                cwd=template_repo_path,
+            ).splitlines()
+        ]
+        if not pending:
+            return
+        logging.info("pushing %d branches", len(pending))
+        start = time.monotonic()
+        my_env = os.environ.copy()
+        my_env["GIT_SSH_COMMAND"] = cfbot_config.GIT_SSH_COMMAND
+        result = run(
+            ["git", "push", "--porcelain", "-f", cfbot_config.GIT_REMOTE_NAME]
+            + [
+                f"{commit_id}:refs/heads/{ref[len(PUSH_REF_PREFIX) :]}"
+                for commit_id, ref in pending
+            ],
+            cwd=template_repo_path,
+            env=my_env,
+            check=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            encoding="utf-8",
+        )
+        # the remote can accept some refs and reject others, and reports on
+        # each one in a line "<flag>\t<from>:<to>\t<summary>"
+        accepted = set()
+        rejected = 0
+        for line in result.stdout.splitlines():
+            fields = line.split("\t")
+            if len(fields) != 3 or ":" not in fields[1]:
+                continue
+            flag, to = fields[0], fields[1].split(":", 1)[1]
+            if flag == "!":
+                logging.error("push of %s was rejected: %s", to, fields[2])
+                rejected += 1
+            else:
+                accepted.add(to)
+        if not accepted and not rejected:
+            # we didn't get as far as talking about refs
+            raise subprocess.CalledProcessError(
+                result.returncode, result.args, result.stdout, result.stderr
+            )
+        logging.info(
+            "pushed %d branches in %.1fs, %d rejected",
+            len(accepted),
+            time.monotonic() - start,
+            rejected,
+        )
+        # forget the ones that were pushed, unless they've been replaced with
+        # newer commits since; the rejected ones will be tried again next time
+        for commit_id, ref in pending:
+            if "refs/heads/" + ref[len(PUSH_REF_PREFIX) :] not in accepted:
+                continue
+            run(
+                ["git", "update-ref", "-d", ref, commit_id],
+                cwd=template_repo_path,
+                check=False,
+                silent=True,
+            )
+
+
+def write_apply_log(submission_id, commit_id, output):
+    """Write the patch output to a public log file, and return its URL."""
     log_file = f"patch_{submission_id}.log"
     log_content = (
         "=== Applying patches on top of PostgreSQL commit ID %s ===\n" % (commit_id,)
@@ -458,9 +728,325 @@ def process_submission(conn, commitfest_id, submission_id):
     )
     with open(os.path.join(cfbot_config.WEB_ROOT, log_file), "w+") as f:
         f.write(log_content)
-    log_url = cfbot_config.CFBOT_APPLY_URL % log_file
+    return cfbot_config.CFBOT_APPLY_URL % log_file
+
+
+def insert_branch(
+    conn,
+    commitfest_id,
+    submission_id,
+    commit_id,
+    status,
+    log_url,
+    version,
+    stats,
+    tree_id=None,
+):
+    """Record the outcome of applying a submission's patches, and queue up a
+    job to tell the commitfest app about it."""
+    cursor = conn.cursor()
+    if status == "failed":
+        cursor.execute(
+            """INSERT INTO branch (commitfest_id, submission_id, status, url, created, modified) VALUES (%s, %s, 'failed', %s, now(), now()) RETURNING id""",
+            (commitfest_id, submission_id, log_url),
+        )
+    else:
+        cursor.execute(
+            """INSERT INTO branch (commitfest_id, submission_id, commit_id, status, url, created, modified, version, patch_count, first_additions, first_deletions, all_additions, all_deletions, tree_id) VALUES (%s, %s, %s, %s, %s, now(), now(), %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
+            (
+                commitfest_id,
+                submission_id,
+                commit_id,
+                status,
+                log_url,
+                version,
+            )
+            + tuple(stats)
+            + (tree_id,),
+        )
+    (branch_id,) = cursor.fetchone()
+    cfbot_work_queue.insert_work_queue(cursor, "post-branch-status", branch_id)
+    return branch_id
+
+
+class StageTimer:
+    """Measure how long each stage of processing a submission takes, so that
+    the statistics page can show where the time goes.  Time spent in a stage
+    that is entered more than once is added up."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def add(self, name, elapsed):
+        self.stages[name] = self.stages.get(name, 0) + elapsed
+
+
+def insert_branch_timing(conn, branch_id, timer):
+    if branch_id is None:
+        # we didn't make a branch, because nothing changed
+        return
+    cursor = conn.cursor()
+    for stage, elapsed in timer.stages.items():
+        cursor.execute(
+            """INSERT INTO branch_timing (branch_id, stage, elapsed)
+                    VALUES (%s, %s, %s * interval '1 second')""",
+            (branch_id, stage, elapsed),
+        )
+
+
+def unchanged_tree(conn, submission_id, tree_id):
+    """Is tree_id the tree of the submission's last branch, and is that branch
+    still being tested or did it pass?  Failures are tried again, in case they
+    were caused by something other than the patches."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT tree_id, status
+                      FROM branch
+                     WHERE submission_id = %s
+                  ORDER BY created DESC
+                     LIMIT 1""",
+        (submission_id,),
+    )
+    if row := cursor.fetchone():
+        last_tree_id, last_status = row
+        return last_tree_id == tree_id and last_status in ("testing", "finished")
+    return False
+
+
+def record_applied(
+    conn,
+    base_commit_id,
+    tip_commit,
+    status,
+    commitfest_id,
+    submission_id,
+    message_id,
+    version,
+    log_url,
+    stats,
+):
+    """Make the merge commit for a submission whose patches applied, queue it
+    to be pushed unless it's blocked, and record the new branch, returning its
+    ID.  If the tree is the same as the last branch's, and that is still being
+    tested or passed, there might be nothing to do, and then None is
+    returned."""
+    template_repo_path = patchburner_ctl("template-repo-path").strip()
+    tree_id = cfbot_git.object_id(template_repo_path, tip_commit + "^{tree}")
+    directive = None
+    if (
+        status == "testing"
+        and cfbot_config.SKIP_UNCHANGED_TREES
+        and unchanged_tree(conn, submission_id, tree_id)
+    ):
+        if not cfbot_config.UNCHANGED_TREE_CI_DIRECTIVE:
+            logging.info(
+                "tree for submission %s is unchanged, not pushing", submission_id
+            )
+            return None
+        directive = cfbot_config.UNCHANGED_TREE_CI_DIRECTIVE
+    commit_id = commit_merge(
+        conn,
+        template_repo_path,
+        base_commit_id,
+        tip_commit,
+        commitfest_id,
+        submission_id,
+        message_id,
+        version,
+        directive,
+    )
+    if status != "blocked" and cfbot_config.GIT_REMOTE_NAME:
+        queue_push(conn, f"cf/{submission_id}", commit_id)
+    return insert_branch(
+        conn,
+        commitfest_id,
+        submission_id,
+        commit_id,
+        status,
+        log_url,
+        version,
+        stats,
+        tree_id,
+    )
+
+
+def process_cached_apply(
+    conn, cached, base_commit_id, commitfest_id, submission_id, message_id, version
+):
+    """Record the outcome of applying a submission's patches from the apply
+    cache, and return the new branch's ID, if one was made."""
+    status, tip_commit, output, *stats = cached
+    log_url = write_apply_log(submission_id, base_commit_id, output)
+    if status == "empty":
+        logging.info("no patches found for (%s, %s)", commitfest_id, submission_id)
+        return None
+    if status == "failed":
+        return insert_branch(
+            conn, commitfest_id, submission_id, None, status, log_url, None, None
+        )
+    else:
+        return record_applied(
+            conn,
+            base_commit_id,
+            tip_commit,
+            status,
+            commitfest_id,
+            submission_id,
+            message_id,
+            version,
+            log_url,
+            stats,
+        )
+
+
+def expected_message_id(conn, commitfest_id, submission_id):
+    """Return the ID of the latest message with patches that we've seen in a
+    submission's thread, if any."""
+    cursor = conn.cursor()
+    cursor.execute(
+        """SELECT last_message_id
+                      FROM submission
+                     WHERE commitfest_id = %s AND submission_id = %s""",
+        (commitfest_id, submission_id),
+    )
+    if row := cursor.fetchone():
+        return row[0]
+    return None
+
+
+def process_submission(commitfest_id, submission_id, slot=0):
+    process_submission_in_slot(
+        slot, cfbot_util.lock("burner-%d" % slot), commitfest_id, submission_id
+    )
+
+
+def fetch_submission(commitfest_id, submission_id, timer, connect=cfbot_util.db):
+    """Find and download the latest patches for a submission, with a database
+    connection of its own so that it can run in the background while another
+    submission is being applied.  Return (message_id, patches, version,
+    patch_hash), or None if the submission has no thread."""
+    with connect() as conn:
+        # fetch the patches from the thread
+        with timer.stage("thread"):
+            try:
+                thread_url = cfbot_commitfest_rpc.get_thread_url_for_submission(
+                    commitfest_id, submission_id
+                )
+            except requests.exceptions.HTTPError as e:
+                # We've seen some 404's here, probably due to a previously existing entry
+                # being deleted.
+                if e.response.status_code == 404:
+                    thread_url = None
+                else:
+                    raise
+
+        if not thread_url:
+            # CF entry with no thread attached?
+            update_submission(conn, None, None, commitfest_id, submission_id)
+            conn.commit()
+            logging.info("skipping submission %s with no thread" % submission_id)
+            return None
+
+        # Try to close the race against slow archives: make sure that the latest
+        # message that we've already seen in the thread is visible.  That's
+        # usually true straight away.
+        with timer.stage("wait"):
+            if not cfbot_commitfest.wait_for_message(
+                conn,
+                thread_url,
+                expected_message_id(conn, commitfest_id, submission_id),
+                cfbot_config.THREAD_WAIT_TIMEOUT,
+            ):
+                logging.info(
+                    "gave up waiting for the archives to show the latest message for submission %s",
+                    submission_id,
+                )
+        with timer.stage("thread"):
+            message_id, patch_urls = cfbot_commitfest.get_latest_patches(
+                conn, thread_url, pull=False
+            )
+    with timer.stage("download"):
+        patches, version = download_patches(patch_urls)
+    return message_id, patches, version, hash_patches(patches)
+
+
+def process_submission_in_burner(
+    conn, commitfest_id, submission_id, slot, fetched, timer, recycling=None
+):
+    """Apply a submission's patches, as returned by fetch_submission(), in a
+    slot whose lock we hold, waiting for the slot's burner to be recycled
+    first if recycling is given (see take_burner()).  Return True if the
+    burner can be recycled afterwards, False if it should be kept for
+    debugging, or None if it wasn't used."""
+    message_id, patches, version, patch_hash = fetched
+
+    # have we applied these patches to this master commit before?
+    commit_id = template_base_commit()
+    if commit_id and (cached := get_apply_cache(conn, commit_id, patch_hash)):
+        logging.info(
+            "reusing apply result for (%s, %s) on %s"
+            % (commitfest_id, submission_id, commit_id)
+        )
+        with timer.stage("record"):
+            branch_id = process_cached_apply(
+                conn,
+                cached,
+                commit_id,
+                commitfest_id,
+                submission_id,
+                message_id,
+                version,
+            )
+        insert_branch_timing(conn, branch_id, timer)
+        update_submission(conn, message_id, commit_id, commitfest_id, submission_id)
+        conn.commit()
+        # we didn't touch the burner
+        return None
+
+    burner_repo_path = patchburner_ctl("burner-repo-path", slot).strip()
+    patch_dir = patchburner_ctl("burner-patch-path", slot).strip()
+
+    # this resets the template and creates a burner, unless one was ready
+    with timer.stage("burner"):
+        commit_id = take_burner(conn, slot, recycling)
+    logging.info(
+        "processing submission %d, %d in slot %d" % (commitfest_id, submission_id, slot)
+    )
+
+    # note the base commit, so we can see which files are changed
+    base_commit = get_commit_id(burner_repo_path)
+
+    # put the patches in the patchburner's filesystem, where the jail can see
+    # them
+    for filename, content in patches:
+        with open(os.path.join(patch_dir, filename), "wb+") as f:
+            f.write(content)
+    # we applied the patch; now make it into a branch with a commit on it
+    branch = make_branch(burner_repo_path, submission_id)
+    # apply the patches inside the jail
+    with timer.stage("apply"):
+        output, rcode = patchburner_ctl("apply", slot, want_rcode=True)
+    for strategy, result, seconds in RE_APPLY_TIMING.findall(output):
+        timer.add(f"apply: {strategy} ({result})", float(seconds))
+    log_url = write_apply_log(submission_id, commit_id, output)
+    # There may have been no patches to apply, for example because a tarball
+    # contained something else.  That's not a failure, and there's no branch
+    # to record.
+    if rcode == NO_PATCHES_RCODE:
+        logging.info("no patches found for (%s, %s)", commitfest_id, submission_id)
+        insert_apply_cache(conn, commit_id, patch_hash, "empty", None, output)
+        branch_id = None
+
     # did "patch" actually succeed?
-    if rcode != 0:
+    elif rcode != 0:
         # we failed to apply the patches
         tail = "\n".join(output.rstrip().split("\n")[-3:])
         logging.info(
@@ -469,93 +1055,90 @@ def process_submission(conn, commitfest_id, submission_id):
         )
         if submission_id == 4351:  # Peter Geoghegan's problematic patch
             logging.info("full apply log for submission 4351:\n%s" % output)
-        cursor.execute(
-            """INSERT INTO branch (commitfest_id, submission_id, status, url, created, modified) VALUES (%s, %s, 'failed', %s, now(), now()) RETURNING id""",
-            (commitfest_id, submission_id, log_url),
+        branch_id = insert_branch(
+            conn, commitfest_id, submission_id, None, "failed", log_url, None, None
         )
-        (branch_id,) = cursor.fetchone()
-        cfbot_work_queue.insert_work_queue(cursor, "post-branch-status", branch_id)
+        # Only remember genuine conflicts.  Other exit codes could mean that
+        # the sandbox itself failed, and that might not happen next time.
+        if rcode == 1:
+            insert_apply_cache(conn, commit_id, patch_hash, "failed", None, output)
         if not cfbot_config.PRODUCTION:
             print(output)
 
     else:
         logging.info("applied patches for (%s, %s)" % (commitfest_id, submission_id))
-        first_commit = capture(
-            "git rev-list --topo-order master..HEAD | tail -n 1", cwd=burner_repo_path
-        ).strip()
-        commit_count = int(
-            capture(
-                "git rev-list --topo-order master..HEAD | wc -l", cwd=burner_repo_path
-            ).strip()
-        )
-
-        # check for paths that we don't allow patches to modify
-        #
-        # XXX We could have an endpoint that the cf app could use to "release"
-        # this blocked branch (ie try again).  We'd probably need to change the
-        # lifecycle of "branch" records, ie create them *before* trying to
-        # apply, rather than after, and then have work queue jobs that work on
-        # them, or something like that?
-        changed_files = capture(
-            "git diff --name-only %s" % base_commit, cwd=burner_repo_path
-        )
-        push_blocked = False
-        for name in changed_files:
-            name = name.rstrip()
-            if re.match(cfbot_config.PUSH_BLOCKED_PATTERN, name):
-                logging.info("patch changes file %s, blocking", name)
-                push_blocked = True
-
-        # we committed the patches; now add a final merge commit with some metadata
-        add_merge_commit(
-            conn, burner_repo_path, commitfest_id, submission_id, message_id, version
-        )
-
-        if commit_count > 0:
-            first_additions, first_deletions = git_shortstat(
-                burner_repo_path, first_commit
+        with timer.stage("inspect"):
+            tip_commit = get_commit_id(burner_repo_path)
+            commits = cfbot_git.rev_list(
+                burner_repo_path, "--topo-order", "master..HEAD"
+            )
+            commit_count = len(commits)
+            first_commit = commits[-1] if commits else None
+
+            # check for paths that we don't allow patches to modify
+            #
+            # XXX We could have an endpoint that the cf app could use to "release"
+            # this blocked branch (ie try again).  We'd probably need to change the
+            # lifecycle of "branch" records, ie create them *before* trying to
+            # apply, rather than after, and then have work queue jobs that work on
+            # them, or something like that?
+            changed_files = cfbot_git.git(
+                burner_repo_path, "diff", "--name-only", base_commit
+            ).splitlines()
+            push_blocked = False
+            for name in changed_files:
+                if re.match(cfbot_config.PUSH_BLOCKED_PATTERN, name):
+                    logging.info("patch changes file %s, blocking", name)
+                    push_blocked = True
+
+            update_submission_files(conn, commitfest_id, submission_id, changed_files)
+
+            if commit_count > 0:
+                first_additions, first_deletions = git_shortstat(
+                    burner_repo_path, first_commit
+                )
+                all_additions, all_deletions = git_shortstat(burner_repo_path, "HEAD")
+            else:
+                first_additions, first_deletions = 0, 0
+                all_additions, all_deletions = 0, 0
+            stats = (
+                commit_count,
+                first_additions,
+                first_deletions,
+                all_additions,
+                all_deletions,
             )
-            all_additions, all_deletions = git_shortstat(burner_repo_path, "HEAD")
-        else:
-            first_additions, first_deletions = 0, 0
-            all_additions, all_deletions = 0, 0
 
-        # push it to the remote monitored repo, if configured
-        if not push_blocked and cfbot_config.GIT_REMOTE_NAME:
-            logging.info("pushing branch %s" % branch)
-            my_env = os.environ.copy()
-            my_env["GIT_SSH_COMMAND"] = cfbot_config.GIT_SSH_COMMAND
-            subprocess.check_call(
-                "cd %s && git push -q -f %s %s"
-                % (burner_repo_path, cfbot_config.GIT_REMOTE_NAME, branch),
-                env=my_env,
-                shell=True,
-                stderr=subprocess.DEVNULL,
+        # Copy the applied commits into the template repo, where they're kept
+        # for next time and the merge commit is made and pushed from.
+        with timer.stage("save"):
+            save_applied_commits(
+                burner_repo_path, branch, applied_ref(commit_id, patch_hash)
             )
+
         # record the apply status
-        ci_commit_id = get_commit_id(burner_repo_path)
         if push_blocked:
             branch_status = "blocked"
         else:
             branch_status = "testing"
-        cursor.execute(
-            """INSERT INTO branch (commitfest_id, submission_id, commit_id, status, url, created, modified, version, patch_count, first_additions, first_deletions, all_additions, all_deletions) VALUES (%s, %s, %s, %s, %s, now(), now(), %s, %s, %s, %s, %s, %s) RETURNING id""",
-            (
+        with timer.stage("record"):
+            branch_id = record_applied(
+                conn,
+                commit_id,
+                tip_commit,
+                branch_status,
                 commitfest_id,
                 submission_id,
-                ci_commit_id,
-                branch_status,
-                log_url,
+                message_id,
                 version,
-                commit_count,
-                first_additions,
-                first_deletions,
-                all_additions,
-                all_deletions,
-            ),
+                log_url,
+                stats,
+            )
+        insert_apply_cache(
+            conn, commit_id, patch_hash, branch_status, tip_commit, output, stats
         )
-        (branch_id,) = cursor.fetchone()
-        cfbot_work_queue.insert_work_queue(cursor, "post-branch-status", branch_id)
+
+    insert_branch_timing(conn, branch_id, timer)
 
     # record that we have processed this commit ID and message ID
     #
@@ -571,22 +1154,184 @@ def process_submission(conn, commitfest_id, submission_id):
     # we'll leave it around so that we can see the results of patch apply.
     # Also if we're in a dev environment let's keep it around on failure to make
     # debugging easier.
-    if cfbot_config.GIT_REMOTE_NAME and (cfbot_config.PRODUCTION or rcode == 0):
-        patchburner_ctl("destroy")
+    return bool(
+        cfbot_config.GIT_REMOTE_NAME and (cfbot_config.PRODUCTION or rcode == 0)
+    )
 
 
-def maybe_process_one(conn, cf_ids):
-    if not need_to_limit_rate(conn):
-        commitfest_id, submission_id = choose_submission(conn, cf_ids)
-        if submission_id:
-            process_submission(conn, commitfest_id, submission_id)
-    else:
-        pass
-        # logging.info(
-        #     "rate limiting in effect, see CONCURRENT_BUILDS in cfbot_config.py"
-        # )
+class SubmissionChooser:
+    """Hand out due submissions to slots, one at a time, so that no two slots
+    take the same one.  Submissions that have been chosen but not yet recorded
+    as branches count towards the limit on concurrent builds."""
+
+    def __init__(self, cf_ids, deadline=None):
+        self.cf_ids = cf_ids
+        self.deadline = deadline
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.limit = None
+
+    def choose(self, conn):
+        """Return the ID pair of the next submission to process, or None if
+        nothing is due, we're rate limited, or we've run out of time."""
+        with self.lock:
+            if cfbot_commitfest.out_of_time(self.deadline):
+                return None
+            if self.limit is None:
+                # decided once per run, as it only changes slowly
+                self.limit = concurrent_builds_limit(conn)
+            if need_to_limit_rate(conn, len(self.in_flight), self.limit):
+                # logging.info(
+                #     "rate limiting in effect, see CONCURRENT_BUILDS in cfbot_config.py"
+                # )
+                return None
+            commitfest_id, submission_id = cfbot_scheduler.choose_submission(
+                conn, self.cf_ids, self.in_flight
+            )
+            if not submission_id:
+                return None
+            self.in_flight.add(submission_id)
+            return commitfest_id, submission_id
+
+    def done(self, submission_id):
+        with self.lock:
+            self.in_flight.discard(submission_id)
+
+
+def process_submission_in_slot(
+    slot, lock_fd, commitfest_id, submission_id, chooser=None, connect=cfbot_util.db
+):
+    """Process a submission in a slot whose lock is held by lock_fd, with
+    database connections of its own from connect() so that it can run in its
+    own thread.  If a chooser is given, keep going with more submissions from
+    it, downloading the next one's patches while the current one is applied,
+    and recycling the burner in the background while the next one's patches
+    are downloaded.  The slot is released once its burner has been
+    recycled."""
+    # recycling happens in order in this thread, and then the slot is released
+    recycler = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="burner-%d" % slot
+    )
+    recycling = None
+    recycle = False
+    try:
+        with connect() as conn:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetcher:
+                timer = StageTimer()
+                fetching = prefetcher.submit(
+                    fetch_submission, commitfest_id, submission_id, timer, connect
+                )
+                while fetching:
+                    try:
+                        fetched = fetching.result()
+                        fetching = None
+                        if chooser and (next_submission := chooser.choose(conn)):
+                            next_timer = StageTimer()
+                            fetching = prefetcher.submit(
+                                fetch_submission, *next_submission, next_timer, connect
+                            )
+                        if fetched:
+                            result = process_submission_in_burner(
+                                conn,
+                                commitfest_id,
+                                submission_id,
+                                slot,
+                                fetched,
+                                timer,
+                                recycling,
+                            )
+                            if result is not None:
+                                recycle = result
+                    finally:
+                        if chooser:
+                            chooser.done(submission_id)
+                    if fetching:
+                        if recycle:
+                            # the next submission's take_burner() waits for this
+                            recycling = recycler.submit(refresh_burner, slot, connect)
+                            recycle = False
+                        commitfest_id, submission_id = next_submission
+                        timer = next_timer
+    finally:
+        if recycle:
+            recycler.submit(refresh_burner, slot, connect)
+        recycler.submit(lock_fd.close)
+        recycler.shutdown(wait=False)
+
+
+def maybe_process_submissions(conn, cf_ids, connect=cfbot_util.db, deadline=None):
+    """Fill as many free patchburner slots as we can with submissions, and
+    process them concurrently, each slot carrying on with more submissions
+    until the deadline.  Slots that are busy (for example because someone is
+    running this script by hand, or a burner is being recycled) are skipped.
+    Free slots that don't get a submission have their burners created or
+    brought up to date in the background.  The slots get their database
+    connections from connect()."""
+    free_slots = {}
+    try:
+        for slot in range(cfbot_config.PATCHBURNER_SLOTS):
+            if lock_fd := cfbot_util.try_lock("burner-%d" % slot):
+                free_slots[slot] = lock_fd
+
+        # Choose a different submission for each slot to start with.
+        chooser = SubmissionChooser(cf_ids, deadline)
+        jobs = []
+        for slot in free_slots:
+            if not (chosen := chooser.choose(conn)):
+                break
+            jobs.append((slot,) + chosen)
+
+        # keep the burners of idle slots warm
+        base_commit_id = template_base_commit()
+        for slot in list(free_slots):
+            if slot in (job[0] for job in jobs):
+                continue
+            ready_commit_id = ready_burner_commit(slot)
+            if ready_commit_id:
+                stale = base_commit_id and ready_commit_id != base_commit_id
+            else:
+                # don't clobber a burner that was kept for debugging
+                burner_repo_path = patchburner_ctl("burner-repo-path", slot).strip()
+                stale = not os.path.exists(burner_repo_path)
+            if stale:
+                start_recycle_burner(slot, free_slots.pop(slot), connect)
+        if not jobs:
+            return
+
+        failure = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = {}
+            for slot, commitfest_id, submission_id in jobs:
+                future = executor.submit(
+                    process_submission_in_slot,
+                    slot,
+                    free_slots.pop(slot),
+                    commitfest_id,
+                    submission_id,
+                    chooser,
+                    connect,
+                )
+                futures[future] = slot, commitfest_id, submission_id
+            for future in concurrent.futures.as_completed(futures):
+                slot, commitfest_id, submission_id = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # let the other slots finish, then blow up
+                    logging.error(
+                        "failed to process submission %d, %d in slot %d: %s",
+                        commitfest_id,
+                        submission_id,
+                        slot,
+                        e,
+                    )
+                    failure = failure or e
+        if failure:
+            raise failure
+    finally:
+        for lock_fd in free_slots.values():
+            lock_fd.close()
 
 
 if __name__ == "__main__":
-    with cfbot_util.db() as conn:
-        process_submission(conn, int(sys.argv[1]), int(sys.argv[2]))
+    process_submission(int(sys.argv[1]), int(sys.argv[2]))
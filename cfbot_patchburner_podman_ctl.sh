@@ -4,18 +4,33 @@
 
 set -e
 
+# Each burner slot has its own directory and container, so that several
+# submissions can be processed at the same time.
+SLOT=${2:-0}
+
 TEMPLATE_DIR=patchburner_template
-MOUNTED_DIR=patchburner_podman
+# Burners borrow the template's objects through git alternates, which name
+# them by absolute path, so the container needs to see them at the same path.
+TEMPLATE_OBJECTS=$PWD/$TEMPLATE_DIR/work/postgresql/.git/objects
+MOUNTED_DIR=patchburner_podman_$SLOT
+CONTAINER_NAME=cfbot-patchburner-$SLOT
+
+# The image is tagged with a hash of the files it is built from, so that it
+# only has to be built again when one of them changes.
+IMAGE_NAME=cfbot-patchburner:$(cat Dockerfile apply-patches.sh | sha256sum | cut -c1-16)
 
 usage() {
-	echo "Usage: $1 init|create|apply|destroy"
+	echo "Usage: $1 init-template|build-image|create|apply|destroy [slot]"
 	echo
 	echo "init-template -- create 'patchburner_template'"
 	echo
-	echo "create -- create a new podman image with the cfbot-patchburner tag"
+	echo "build-image -- build the podman image, if it isn't up to date"
+	echo "create -- create a new 'patchburner' from the template"
 	echo "apply -- apply all the patches found in patchburner/work/patches'"
 	echo "destroy -- destroy 'patchburner' if it exists"
 	echo
+	echo "slot defaults to 0, and selects one of several independent burners"
+	echo
 	echo "template-repo-patch -- report path of template git repo"
 	echo "burner-patch-path -- report path where patches should be placed"
 	echo "burner-repo-path -- report path of burner git repo"
@@ -30,32 +45,52 @@ init_template() {
 	mkdir $TEMPLATE_DIR
 	mkdir $TEMPLATE_DIR/work
 	git clone https://git.postgresql.org/git/postgresql.git $TEMPLATE_DIR/work/postgresql
+	build_image_if_missing
 }
 
 destroy_patchburner_if_exists() {
 	rm -fr $MOUNTED_DIR
 }
 
+build_image_if_missing() {
+	if ! podman image inspect $IMAGE_NAME >/dev/null 2>&1; then
+		podman build . -t $IMAGE_NAME
+	fi
+}
+
 create_patchburner() {
-	# Copy the template to get a clean up-to-date repo.
-	cp -r $TEMPLATE_DIR $MOUNTED_DIR
+	# Make a clean up-to-date repo by cloning the template with --shared, so
+	# that only the working tree is written out and no objects are copied.
+	# The template's config replaces the clone's, so that the burner pushes
+	# to the same remotes as a full copy would.
+	mkdir -p $MOUNTED_DIR/work
+	git clone -q --shared $PWD/$TEMPLATE_DIR/work/postgresql $MOUNTED_DIR/work/postgresql
+	cp $TEMPLATE_DIR/work/postgresql/.git/config $MOUNTED_DIR/work/postgresql/.git/config
 
 	mkdir $MOUNTED_DIR/work/patches
-
-	podman build . -t cfbot-patchburner
 }
 
 apply_patches_in_patchburner() {
-	podman run --mount=type=bind,source=$PWD/$MOUNTED_DIR/work,target=/work --workdir=/work/postgresql cfbot-patchburner /usr/local/bin/apply-patches.sh
+	build_image_if_missing
+	# with "set -e", a failure would otherwise skip the clean-up below
+	if podman run --rm --name $CONTAINER_NAME --mount=type=bind,source=$PWD/$MOUNTED_DIR/work,target=/work --mount=type=bind,source=$TEMPLATE_OBJECTS,target=$TEMPLATE_OBJECTS,readonly --workdir=/work/postgresql $IMAGE_NAME /usr/local/bin/apply-patches.sh; then
+		result=0
+	else
+		result=$?
+	fi
 	rm -rf $MOUNTED_DIR/work/postgresql/.git/hooks
 	rm -rf $MOUNTED_DIR/work/postgresql/.git/config
 	cp $TEMPLATE_DIR/work/postgresql/.git/config $MOUNTED_DIR/work/postgresql/.git/config
+	exit $result
 }
 
 case $1 in
 init-template)
 	init_template
 	;;
+build-image)
+	build_image_if_missing
+	;;
 create)
 	create_patchburner
 	;;
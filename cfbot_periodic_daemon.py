@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# A resident process that runs the periodic duties that used to be started by
+# cron, so that we don't pay for a fresh interpreter, imports, database
+# connections and HTTP sessions every minute, and so that in-memory caches
+# survive from one cycle to the next.  Run it under supervisord, like
+# cfbot_worker.
+#
+# Each duty runs in its own thread.  If a duty is still running when its next
+# tick comes around, that tick is skipped rather than queued up behind it.
+
+import cfbot_config
+import cfbot_periodic_daily
+import cfbot_periodic_hourly
+import cfbot_periodic_minutely
+import cfbot_util
+import cfbot_web_statistics
+
+import datetime
+import logging
+import os
+import setproctitle
+import subprocess
+import threading
+import time
+
+
+class Duty:
+    """Something to run whenever the wall clock matches a crontab-style
+    minute and hour (None matching any value)."""
+
+    def __init__(self, name, function, minute=None, hour=None):
+        self.name = name
+        self.function = function
+        self.minute = minute
+        self.hour = hour
+        self.busy = threading.Lock()
+
+    def due(self, now):
+        return (self.minute is None or now.minute == self.minute) and (
+            self.hour is None or now.hour == self.hour
+        )
+
+    def tick(self):
+        if not self.busy.acquire(blocking=False):
+            logging.info("skipping %s tick, previous run is still going", self.name)
+            return
+        threading.Thread(target=self.run, name=self.name, daemon=True).start()
+
+    def run(self):
+        try:
+            self.function()
+        except Exception:
+            # keep going, we'll try again next time
+            logging.exception("periodic duty %s failed", self.name)
+        finally:
+            self.busy.release()
+
+
+pool = cfbot_util.ConnectionPool()
+
+
+def minutely():
+    cfbot_periodic_minutely.main(pool.connection)
+
+
+def hourly():
+    with pool.connection() as conn:
+        cfbot_periodic_hourly.run(conn)
+    subprocess.check_call("./dump_status_stats.sh")
+
+
+def daily():
+    with pool.connection() as conn:
+        cfbot_periodic_daily.run(conn)
+
+
+def statistics():
+    with pool.connection() as conn:
+        cfbot_web_statistics.build_page(
+            conn, os.path.join(cfbot_config.WEB_ROOT, "statistics.html")
+        )
+
+
+# Same schedule as the crontab entries this replaces.
+DUTIES = (
+    Duty("minutely", minutely),
+    Duty("hourly", hourly, minute=0),
+    Duty("daily", daily, minute=0, hour=0),
+    Duty("statistics", statistics, minute=12, hour=0),
+)
+
+
+def run():
+    setproctitle.setproctitle("cfbot periodic")
+    while True:
+        # sleep until the start of the next minute
+        time.sleep(60 - time.time() % 60)
+        now = datetime.datetime.now()
+        for duty in DUTIES:
+            if duty.due(now):
+                duty.tick()
+
+
+if __name__ == "__main__":
+    run()
@@ -2,15 +2,25 @@
 
 import cfbot_gc
 import cfbot_github
+import cfbot_patch
 import cfbot_util
 
+
+def run(conn):
+    cfbot_gc.gc(conn)
+    conn.commit()
+
+    # Now that we've deleted build records older than RETENTION_ALL, we can
+    # delete unreferenced remote branches to avoid leaving junk in our
+    # Github account.
+    cfbot_github.gc_remote_branches(conn)
+    conn.commit()
+
+    # Keep the template repo's objects tidy, after the apply cache refs that
+    # we just deleted have stopped holding on to some of them.
+    cfbot_patch.maintain_template()
+
+
 if __name__ == "__main__":
     with cfbot_util.db() as conn:
-        cfbot_gc.gc(conn)
-        conn.commit()
-
-        # Now that we've deleted build records older than RETENTION_ALL, we can
-        # delete unreferenced remote branches to avoid leaving junk in our
-        # Github account.
-        cfbot_github.gc_remote_branches(conn)
-        conn.commit()
+        run(conn)
@@ -1,10 +1,22 @@
 #!/usr/bin/env python3
 
 import cfbot_github
+import cfbot_scheduler
 import cfbot_util
+import cfbot_work_queue
+
+
+def run(conn):
+    cfbot_github.refresh_build_status_statistics(conn)
+    cfbot_github.refresh_task_status_statistics(conn)
+    cfbot_scheduler.update_due_times(conn.cursor())
+    # in case we missed the webhook for a master build
+    cfbot_work_queue.insert_work_queue_if_not_exists(
+        conn.cursor(), "fetch-template-base"
+    )
+    conn.commit()
+
 
 if __name__ == "__main__":
     with cfbot_util.db() as conn:
-        cfbot_github.refresh_build_status_statistics(conn)
-        cfbot_github.refresh_task_status_statistics(conn)
-        conn.commit()
+        run(conn)
@@ -2,67 +2,131 @@
 
 import cfbot_commitfest
 import cfbot_commitfest_rpc
-import cfbot_config
 import cfbot_github
 import cfbot_patch
 import cfbot_util
 import cfbot_web
 import cfbot_work_queue
 
+import concurrent.futures
 import logging
 import requests
+import time
 
+# Time budgets for the phases of each cycle, in seconds.  Phases that loop
+# over many items stop early when they run out of time, and pick up where they
+# left off next time.  The others just get logged if they overrun, so we can
+# see which upstream is slow.
+PHASE_BUDGETS = {
+    "stale": 20,
+    "commitfest": 30,
+    "threads": 40,
+    "patches": 50,
+    "web": 40,
+}
 
-def run():
-    with cfbot_util.db() as conn:
-        cfbot_work_queue.maybe_trigger_retries(conn)
+# Network errors are expected from time to time, and we'll just try again
+# next time.
+TRANSIENT_ERRORS = (
+    requests.exceptions.ReadTimeout,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.HTTPError,
+)
 
-        # get the current Commitfest ID
-        cfs = cfbot_commitfest_rpc.get_current_commitfests()
 
-        # Look for stuck builds, in case have missed a webhook or it is time to
-        # time out.
-        cfbot_github.check_stale_branches(conn)
-        cfbot_github.check_stale_builds(conn)
-        cfbot_github.check_stale_tasks(conn)
-        conn.commit()
+def check_stale(conn, deadline):
+    cfbot_work_queue.maybe_trigger_retries(conn)
 
-        # XXX We should get this information by receiving a POST from the
-        # cfapp on a new endpoint.  We'd probably want to poll for missed
-        # updates occasionally, but using proper JSON endpoints instead of
-        # scraping, and with low frequency since it'd only be a last resort way
-        # to stay in sync.
-        for name, cf in cfs.items():
-            if cf is None:
-                # logging.info(f"skipping pulling submissions for {name} commitfest")
-                continue
+    # Look for stuck builds, in case have missed a webhook or it is time to
+    # time out.
+    cfbot_github.check_stale_branches(conn)
+    cfbot_github.check_stale_builds(conn)
+    cfbot_github.check_stale_tasks(conn)
+    conn.commit()
 
-            # logging.info(f"pulling submissions for {name} commitfest")
-            cfbot_commitfest.pull_submissions(conn, cf["id"])
 
-        cf_ids = [cf["id"] for cf in cfs.values() if cf is not None]
+def run_phase(connect, name, budget, function, *args):
+    """Run one phase of the cycle in its own thread with its own database
+    connection, since phases don't share any state except what they read
+    from the database."""
+    start = time.monotonic()
+    deadline = start + budget
+    with connect() as conn:
+        function(conn, *args, deadline=deadline)
+    elapsed = time.monotonic() - start
+    if elapsed > budget:
+        logging.info(
+            "phase %s took %.2fs, exceeding its budget of %ds", name, elapsed, budget
+        )
 
-        cfbot_commitfest.pull_modified_threads(conn)
 
-        # XXX This should probably become a work_queue job so that it can also
-        # be queued when a build finishes (instead of waiting for this cron job
-        # to run again), but first we need more sophisticated rate limiting
-        # with the requisite interlocking to make it reliable.
-        cfbot_patch.maybe_process_one(conn, cf_ids)
+def run(connect=cfbot_util.db):
+    # get the current Commitfest ID
+    cfs = cfbot_commitfest_rpc.get_current_commitfests()
+    cf_ids = [cf["id"] for cf in cfs.values() if cf is not None]
 
-        # XXX We should probably stop building web pages, or if we're going to
-        # keep doing it, build them with work_queue jobs when relevant data
-        # changes, not every minute, or just make real dynamic pages with
-        # Flask?
-        cfbot_web.rebuild(conn, cfs, cf_ids)
+    # The phases below are independent of each other, so run them
+    # concurrently.  Each one works from whatever the others had committed
+    # when it started, so for example a thread whose last_email_time moves
+    # during this cycle will be checked next time around.
+    phases = [("stale", check_stale)]
 
+    # XXX We should get this information by receiving a POST from the
+    # cfapp on a new endpoint.  We'd probably want to poll for missed
+    # updates occasionally, but using proper JSON endpoints instead of
+    # scraping, and with low frequency since it'd only be a last resort way
+    # to stay in sync.
+    for name, cf in cfs.items():
+        if cf is None:
+            # logging.info(f"skipping pulling submissions for {name} commitfest")
+            continue
 
-if __name__ == "__main__":
+        # logging.info(f"pulling submissions for {name} commitfest")
+        phases.append(("commitfest", cfbot_commitfest.pull_submissions, cf["id"]))
+
+    phases.append(("threads", cfbot_commitfest.pull_modified_threads))
+
+    # XXX This should probably become a work_queue job so that it can also
+    # be queued when a build finishes (instead of waiting for this cron job
+    # to run again), but first we need more sophisticated rate limiting
+    # with the requisite interlocking to make it reliable.  Its slots need
+    # database connections of their own too.
+    phases.append(("patches", cfbot_patch.maybe_process_submissions, cf_ids, connect))
+
+    # XXX We should probably stop building web pages, or if we're going to
+    # keep doing it, build them with work_queue jobs when relevant data
+    # changes, not every minute, or just make real dynamic pages with
+    # Flask?
+    phases.append(("web", cfbot_web.rebuild, cfs, cf_ids))
+
+    failure = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(phases)) as executor:
+        futures = {
+            executor.submit(
+                run_phase, connect, name, PHASE_BUDGETS[name], function, *args
+            ): name
+            for name, function, *args in phases
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+            except TRANSIENT_ERRORS as e:
+                logging.error("Failed to run phase %s: %s", name, e)
+            except Exception as e:
+                # let the other phases finish, then blow up
+                logging.error("Some unexpected error occured in phase %s: %s", name, e)
+                failure = failure or e
+    if failure:
+        raise failure
+
+
+def main(connect=cfbot_util.db):
     # don't run if we're already running
-    lock_fd = cfbot_util.try_lock()
+    lock_fd = cfbot_util.try_lock("minutely")
     if lock_fd:
         try:
-            run()
+            run(connect)
         except requests.exceptions.ReadTimeout:
             logging.error("Failed to process due to a timeout")
         except requests.exceptions.ConnectionError:
@@ -72,4 +136,9 @@ if __name__ == "__main__":
         except Exception as e:
             logging.error("Some unexpected error occured: %s", e)
             raise
-        lock_fd.close()
+        finally:
+            lock_fd.close()
+
+
+if __name__ == "__main__":
+    main()
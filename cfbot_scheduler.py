@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Decide which submission most needs to be pushed into a new branch next.
+#
+# Every submission has a due_time, computed from its state by the policy
+# below, and choosing the next one to process is just a matter of taking the
+# earliest due_time that has passed, new patches first, using indexes.  The
+# due time is recomputed whenever something that it depends on changes: when
+# we see new mail or a status change from the commitfest app, when a build
+# finishes and backoff changes, when we push a branch, and when master moves.
+# The hourly job recomputes all of them, in case we missed something or the
+# policy changed.
+#
+# The policy is:
+#
+# 1.  Submissions that aren't in one of SCHEDULER_STATUSES or that have no
+#     patches have no due time, and are never chosen.
+# 2.  A new patch is due when it was posted, plus SCHEDULER_NEW_PATCH_DELAY.
+#     That is negative by default, so that it is due straight away.  New
+#     patches that are due are always chosen ahead of bitrot checks, however
+#     long those have been due, so the delay only orders them among
+#     themselves.
+# 3.  Otherwise, a periodic bitrot check is due CYCLE_TIME hours after the
+#     last branch, plus SCHEDULER_FAILED_DELAY if that failed to apply.  If
+#     master has since changed a file that the patches touch, it's due when
+#     that change was built on our mirror of master, plus
+#     SCHEDULER_OVERLAP_DELAY, if that's sooner.  Either way, not before
+#     backoff_until.
+# 4.  SCHEDULER_STATUS_DELAYS can add a delay for each commitfest status.
+#
+# All of the delays are PostgreSQL intervals.
+
+import cfbot_config
+import cfbot_util
+
+import json
+
+DUE_TIME = """
+CASE
+  WHEN s.last_message_id IS NULL
+    OR s.status <> ALL(%s::text[])
+    OR s.submission_id = ANY(%s::int[])
+  THEN NULL
+  WHEN s.last_message_id IS DISTINCT FROM s.last_branch_message_id
+  THEN s.last_email_time + %s::interval
+  ELSE greatest(
+         s.backoff_until,
+         least(
+           coalesce(s.last_branch_time, '-infinity')
+             + interval '1 hour' * %s
+             + CASE WHEN (SELECT b.status
+                            FROM branch b
+                           WHERE b.submission_id = s.submission_id
+                        ORDER BY b.created DESC
+                           LIMIT 1) = 'failed'
+                    THEN %s::interval
+                    ELSE interval '0'
+               END,
+           CASE WHEN s.last_overlap_time > (SELECT min(created)
+                                              FROM build
+                                             WHERE commit_id = s.last_branch_commit_id
+                                               AND branch_name = 'master')
+                 AND s.last_overlap_time <= good.created
+                THEN good.created + %s::interval
+           END))
+END + coalesce((%s::jsonb ->> s.status)::interval, interval '0')"""
+
+
+def due_time_params():
+    return (
+        list(cfbot_config.SCHEDULER_STATUSES),
+        list(cfbot_config.SCHEDULER_EXCLUDED_SUBMISSIONS),
+        cfbot_config.SCHEDULER_NEW_PATCH_DELAY,
+        cfbot_config.CYCLE_TIME,
+        cfbot_config.SCHEDULER_FAILED_DELAY,
+        cfbot_config.SCHEDULER_OVERLAP_DELAY,
+        json.dumps(cfbot_config.SCHEDULER_STATUS_DELAYS),
+    )
+
+
+def update_due_times(cursor, commitfest_id=None, submission_id=None):
+    """Recompute the due time of one submission, or of all of them."""
+    if submission_id is None:
+        where = "TRUE"
+        where_params = ()
+    else:
+        where = "s.commitfest_id = %s AND s.submission_id = %s"
+        where_params = (commitfest_id, submission_id)
+    cursor.execute(
+        f"""WITH good AS (SELECT max(created) AS created
+                            FROM build
+                           WHERE branch_name = 'master'
+                             AND build_id LIKE %s || ':%%'
+                             AND status = 'COMPLETED')
+            UPDATE submission s
+               SET due_time = {DUE_TIME}
+              FROM good
+             WHERE {where}
+               AND s.due_time IS DISTINCT FROM ({DUE_TIME})""",
+        (cfbot_config.GITHUB_FULL_REPO,)
+        + due_time_params()
+        + where_params
+        + due_time_params(),
+    )
+
+
+def in_flight_builds(conn):
+    """Return the number of branches that are still being tested.  Only a
+    handful are at any time, and branch_testing_created_idx covers just
+    those, so this stays cheap however many old branches we keep."""
+    cursor = conn.cursor()
+    cursor.execute("""SELECT count(*)
+                        FROM branch
+                       WHERE status = 'testing'""")
+    (count,) = cursor.fetchone()
+    return count
+
+
+def choose_submission(conn, cf_ids, exclude_ids=()):
+    """Return the ID pair for the submission with a new patch that has been
+    due for longest, or failing that the submission that has been due for
+    longest, ignoring those in exclude_ids, or (None, None) if nothing is
+    due."""
+    cursor = conn.cursor()
+    # each branch of the UNION can walk one of the partial indexes on due_time
+    cursor.execute(
+        """SELECT commitfest_id, submission_id
+                      FROM ((SELECT 0 AS band, commitfest_id, submission_id
+                               FROM submission
+                              WHERE due_time <= now()
+                                AND last_message_id IS DISTINCT FROM last_branch_message_id
+                                AND commitfest_id = ANY(%s)
+                                AND submission_id <> ALL(%s::int[])
+                           ORDER BY due_time
+                              LIMIT 1)
+                            UNION ALL
+                            (SELECT 1 AS band, commitfest_id, submission_id
+                               FROM submission
+                              WHERE due_time <= now()
+                                AND commitfest_id = ANY(%s)
+                                AND submission_id <> ALL(%s::int[])
+                           ORDER BY due_time
+                              LIMIT 1)) AS candidates
+                  ORDER BY band
+                     LIMIT 1""",
+        (cf_ids, list(exclude_ids), cf_ids, list(exclude_ids)),
+    )
+    row = cursor.fetchone()
+    if row:
+        return row
+    else:
+        return None, None
+
+
+if __name__ == "__main__":
+    with cfbot_util.db() as conn:
+        update_due_times(conn.cursor())
+        conn.commit()
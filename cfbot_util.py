@@ -1,8 +1,10 @@
 import cfbot_config
+import contextlib
 import errno
 import fcntl
 import pg8000
 import requests
+import threading
 import time
 import json
 
@@ -72,24 +74,36 @@ def post(url, d):
     response.raise_for_status()
 
 
-def lock():
-    """Big lock to serialise operations that interact with containers,
-    template source tree, web directory...
+# Named locks that we use to serialise operations on shared resources,
+# always acquired in this order to avoid deadlocks:
+#
+# "minutely" -- one cfbot_periodic_minutely.py cycle at a time
+# "burner-N" -- patchburner slot N, taken in ascending order of N
+# "template" -- the template source tree that burners are created from
+# "push"     -- branch creation and deletion in the remote repo
+# "web"      -- generated pages in the web directory
 
-    """
-    ### XXX We should really have finer grained locks... no need for
-    ### the crusty web stuff to block source tree manipulations...
-    fd = open(cfbot_config.LOCK_FILE, "w")
+
+def lock_path(name):
+    return cfbot_config.LOCK_FILE + "-" + name
+
+
+def lock(name):
+    """Take the named lock, waiting if necessary.  The lock is released when
+    the returned file is closed."""
+    fd = open(lock_path(name), "w")
     fcntl.flock(fd, fcntl.LOCK_EX)
     return fd
 
 
-def try_lock():
-    fd = open(cfbot_config.LOCK_FILE, "w")
+def try_lock(name):
+    """Take the named lock if it is free, or return None."""
+    fd = open(lock_path(name), "w")
     try:
         fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
         return fd
     except IOError as e:
+        fd.close()
         if e.errno != errno.EAGAIN:
             raise
         else:
@@ -99,3 +113,31 @@ def try_lock():
 def db():
     """Get a database connection."""
     return pg8000.connect(cfbot_config.DSN)
+
+
+class ConnectionPool:
+    """A pool of database connections for long-running processes, so that
+    each unit of work doesn't have to connect from scratch.  Connections are
+    rolled back when they are returned, and discarded if the work failed."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = db()
+        try:
+            yield conn
+            conn.rollback()
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        with self.lock:
+            self.idle.append(conn)
@@ -2,9 +2,11 @@
 
 import cfbot_config
 import cfbot_util
+import logging
 import math
 import os
 import re
+import time
 import unicodedata
 from html import escape as html_escape
 
@@ -251,8 +253,13 @@ WITH task_positions AS (SELECT DISTINCT ON (task.task_name)
     return results
 
 
-def rebuild(conn, cfs, cf_ids):
+def rebuild(conn, cfs, cf_ids, deadline=None):
     submissions = load_submissions(conn, cf_ids)
+    with cfbot_util.lock("web"):
+        build_pages(conn, cfs, submissions, deadline)
+
+
+def build_pages(conn, cfs, submissions, deadline):
     for name, cf in cfs.items():
         if cf is None:
             continue
@@ -278,6 +285,11 @@ def rebuild(conn, cfs, cf_ids):
         )
 
     for author in unique_authors(submissions):
+        # the author pages are the least interesting, so skip them if we're
+        # short of time
+        if deadline is not None and time.monotonic() > deadline:
+            logging.info("ran out of time building author pages")
+            break
         build_page(
             conn,
             "x",
@@ -284,6 +284,52 @@ select task.task_name,
     """)
 
 
+def per_stage(f, conn):
+    cursor = conn.cursor()
+    f.write("""
+    <h2>Per stage</h2>
+    <p>
+      Time taken, in seconds, by each stage of turning a submission into a
+      branch over the past 7 days, most expensive first.  Numbers are the
+      50th, 90th and 99th percentiles.  Stages that were skipped, for example
+      because the burner was created ahead of time or the result of applying
+      the patches was already known, aren't counted.
+    </p>
+    <table>
+      <tr>
+        <td width="40%">Stage</td>
+        <td width="40%" align="center">Percentiles</td>
+        <td width="20%" align="center">Count</td>
+      </tr>
+""")
+
+    cursor.execute("""
+select stage,
+       percentile_cont(array[0.5, 0.9, 0.99]) within group (order by extract(epoch from elapsed)),
+       count(*)
+  from branch_timing
+  join branch on branch.id = branch_timing.branch_id
+ where branch.created > now() - interval '7 days'
+ group by 1
+ order by 2 desc
+""")
+    for stage, (p50, p90, p99), count in cursor.fetchall():
+        f.write(
+            """
+      <tr>
+        <td>%s</td>
+        <td align="right">%.2f, %.2f, %.2f</td>
+        <td align="right">%d</td>
+      </tr>
+"""
+            % (stage, p50, p90, p99, count)
+        )
+
+    f.write("""
+    </table>
+    """)
+
+
 def footer(f):
     f.write("""
   </body>
@@ -297,6 +343,7 @@ def build_page(conn, path):
         per_day(f, conn)
         per_task(f, conn)
         per_test(f, conn)
+        per_stage(f, conn)
         footer(f)
     os.rename(path + ".tmp", path)
 
@@ -1,10 +1,6 @@
 #!/usr/bin/env python3
 
-import cfbot_commitfest
 import cfbot_config
-import cfbot_github
-import cfbot_highlights
-import cfbot_patch
 import cfbot_util
 import re
 import select
@@ -71,6 +67,13 @@ def maybe_trigger_retries(conn):
 
 
 def process_one_job(conn, fetch_only):
+    # Many modules import this one just to insert jobs, so the job handlers
+    # are only imported by the processes that actually run them.
+    import cfbot_commitfest
+    import cfbot_github
+    import cfbot_highlights
+    import cfbot_patch
+
     cursor = conn.cursor()
     if fetch_only:
         cursor.execute("""select id, type, key, retries
@@ -142,9 +145,14 @@ def process_one_job(conn, fetch_only):
             cfbot_github.poll_github_run(conn, key)
         # Mirroring master, REL_*_STABLE
         elif type == "push-mirror-branch":
-            cfbot_patch.mirror_branch(key)
+            cfbot_patch.mirror_branch(conn, key)
         elif type == "push-delete-branch":
             cfbot_patch.delete_branch(key)
+        elif type == "fetch-template-base":
+            cfbot_patch.update_template_base(conn)
+        # Pushing the branches made by cfbot_patch.py
+        elif type == "push-branches":
+            cfbot_patch.push_branches()
         # Notifying the Commitfest app
         elif type == "post-task-status":
             cfbot_commitfest.post_task_status(conn, key)
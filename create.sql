@@ -47,6 +47,27 @@ SET default_tablespace = '';
 
 SET default_table_access_method = heap;
 
+--
+-- Name: apply_cache; Type: TABLE; Schema: public; Owner: cfbot
+--
+
+CREATE TABLE public.apply_cache (
+    base_commit_id text NOT NULL,
+    patch_hash text NOT NULL,
+    status text NOT NULL,
+    commit_id text,
+    output text NOT NULL,
+    patch_count integer,
+    first_additions integer,
+    first_deletions integer,
+    all_additions integer,
+    all_deletions integer,
+    created timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.apply_cache OWNER TO cfbot;
+
 --
 -- Name: artifact; Type: TABLE; Schema: public; Owner: cfbot
 --
@@ -81,7 +102,8 @@ CREATE TABLE public.branch (
     first_deletions integer,
     all_additions integer,
     all_deletions integer,
-    build_id text
+    build_id text,
+    tree_id text
 );
 
 
@@ -109,6 +131,19 @@ ALTER SEQUENCE public.branch_id_seq OWNER TO cfbot;
 ALTER SEQUENCE public.branch_id_seq OWNED BY public.branch.id;
 
 
+--
+-- Name: branch_timing; Type: TABLE; Schema: public; Owner: cfbot
+--
+
+CREATE TABLE public.branch_timing (
+    branch_id integer NOT NULL,
+    stage text NOT NULL,
+    elapsed interval NOT NULL
+);
+
+
+ALTER TABLE public.branch_timing OWNER TO cfbot;
+
 --
 -- Name: build; Type: TABLE; Schema: public; Owner: cfbot
 --
@@ -186,12 +221,27 @@ CREATE TABLE public.submission (
     last_branch_commit_id text,
     last_branch_time timestamp with time zone,
     backoff_until timestamp with time zone,
-    last_backoff interval
+    last_backoff interval,
+    last_overlap_time timestamp with time zone,
+    due_time timestamp with time zone
 );
 
 
 ALTER TABLE public.submission OWNER TO cfbot;
 
+--
+-- Name: submission_file; Type: TABLE; Schema: public; Owner: cfbot
+--
+
+CREATE TABLE public.submission_file (
+    commitfest_id integer NOT NULL,
+    submission_id integer NOT NULL,
+    path text NOT NULL
+);
+
+
+ALTER TABLE public.submission_file OWNER TO cfbot;
+
 --
 -- Name: task; Type: TABLE; Schema: public; Owner: cfbot
 --
@@ -293,6 +343,21 @@ CREATE TABLE public.test_statistics (
 
 ALTER TABLE public.test_statistics OWNER TO cfbot;
 
+--
+-- Name: thread_message; Type: TABLE; Schema: public; Owner: cfbot
+--
+
+CREATE TABLE public.thread_message (
+    thread_url text NOT NULL,
+    message_id text NOT NULL,
+    "position" integer NOT NULL,
+    attachments text[] NOT NULL,
+    received timestamp with time zone NOT NULL
+);
+
+
+ALTER TABLE public.thread_message OWNER TO cfbot;
+
 --
 -- Name: work_queue; Type: TABLE; Schema: public; Owner: cfbot
 --
@@ -345,6 +410,14 @@ ALTER TABLE ONLY public.branch ALTER COLUMN id SET DEFAULT nextval('public.branc
 ALTER TABLE ONLY public.work_queue ALTER COLUMN id SET DEFAULT nextval('public.work_queue_id_seq'::regclass);
 
 
+--
+-- Name: apply_cache apply_cache_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
+--
+
+ALTER TABLE ONLY public.apply_cache
+    ADD CONSTRAINT apply_cache_pkey PRIMARY KEY (base_commit_id, patch_hash);
+
+
 --
 -- Name: artifact artifact_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
 --
@@ -361,6 +434,14 @@ ALTER TABLE ONLY public.branch
     ADD CONSTRAINT branch_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: branch_timing branch_timing_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
+--
+
+ALTER TABLE ONLY public.branch_timing
+    ADD CONSTRAINT branch_timing_pkey PRIMARY KEY (branch_id, stage);
+
+
 --
 -- Name: build build_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
 --
@@ -377,6 +458,14 @@ ALTER TABLE ONLY public.submission
     ADD CONSTRAINT submission_pkey PRIMARY KEY (commitfest_id, submission_id);
 
 
+--
+-- Name: submission_file submission_file_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
+--
+
+ALTER TABLE ONLY public.submission_file
+    ADD CONSTRAINT submission_file_pkey PRIMARY KEY (commitfest_id, submission_id, path);
+
+
 --
 -- Name: task task_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
 --
@@ -401,6 +490,14 @@ ALTER TABLE ONLY public.test_statistics
     ADD CONSTRAINT test_statistics_pkey PRIMARY KEY (submission_id, task_name, command, suite, test);
 
 
+--
+-- Name: thread_message thread_message_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
+--
+
+ALTER TABLE ONLY public.thread_message
+    ADD CONSTRAINT thread_message_pkey PRIMARY KEY (thread_url, message_id);
+
+
 --
 -- Name: work_queue work_queue_pkey; Type: CONSTRAINT; Schema: public; Owner: cfbot
 --
@@ -416,6 +513,13 @@ ALTER TABLE ONLY public.work_queue
 CREATE INDEX branch_submission_id_created_idx ON public.branch USING btree (submission_id, created);
 
 
+--
+-- Name: branch_testing_created_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX branch_testing_created_idx ON public.branch USING btree (created) WHERE (status = 'testing'::text);
+
+
 --
 -- Name: build_build_status_running_idx; Type: INDEX; Schema: public; Owner: cfbot
 --
@@ -437,6 +541,27 @@ CREATE INDEX build_commit_id_idx ON public.build USING btree (commit_id);
 CREATE INDEX highlight_task_id_type_idx ON public.highlight USING btree (task_id, type);
 
 
+--
+-- Name: submission_due_time_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX submission_due_time_idx ON public.submission USING btree (due_time) WHERE (due_time IS NOT NULL);
+
+
+--
+-- Name: submission_new_patch_due_time_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX submission_new_patch_due_time_idx ON public.submission USING btree (due_time) WHERE ((due_time IS NOT NULL) AND (last_message_id IS DISTINCT FROM last_branch_message_id));
+
+
+--
+-- Name: submission_file_path_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX submission_file_path_idx ON public.submission_file USING btree (path);
+
+
 --
 -- Name: task_command_task_id_name_idx; Type: INDEX; Schema: public; Owner: cfbot
 --
@@ -444,6 +569,13 @@ CREATE INDEX highlight_task_id_type_idx ON public.highlight USING btree (task_id
 CREATE INDEX task_command_task_id_name_idx ON public.task_command USING btree (task_id, name);
 
 
+--
+-- Name: task_status_history_received_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX task_status_history_received_idx ON public.task_status_history USING btree (received);
+
+
 --
 -- Name: task_task_status_running_idx; Type: INDEX; Schema: public; Owner: cfbot
 --
@@ -451,6 +583,13 @@ CREATE INDEX task_command_task_id_name_idx ON public.task_command USING btree (t
 CREATE INDEX task_task_status_running_idx ON public.task USING btree (public.task_status_running(status)) WHERE public.task_status_running(status);
 
 
+--
+-- Name: thread_message_thread_url_position_idx; Type: INDEX; Schema: public; Owner: cfbot
+--
+
+CREATE INDEX thread_message_thread_url_position_idx ON public.thread_message USING btree (thread_url, "position");
+
+
 --
 -- Name: work_queue_type_key_idx; Type: INDEX; Schema: public; Owner: cfbot
 --
@@ -474,6 +613,14 @@ ALTER TABLE ONLY public.branch
     ADD CONSTRAINT branch_commitfest_id_submission_id_fkey FOREIGN KEY (commitfest_id, submission_id) REFERENCES public.submission(commitfest_id, submission_id);
 
 
+--
+-- Name: branch_timing branch_timing_branch_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: cfbot
+--
+
+ALTER TABLE ONLY public.branch_timing
+    ADD CONSTRAINT branch_timing_branch_id_fkey FOREIGN KEY (branch_id) REFERENCES public.branch(id) ON DELETE CASCADE;
+
+
 --
 -- Name: build_status_history build_status_history_build_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: cfbot
 --
@@ -41,6 +41,9 @@ PUSH_BLOCKED_PATTERN = r"^\.github/workflows/.*$"
 SLOW_FETCH_SLEEP = 0.0
 USER_AGENT = "cfbot from http://cfbot.cputube.org"
 TIMEOUT = 20
+# how long to keep polling an archives thread for a message that we expect to
+# be there, because the flat thread can lag behind the commitfest app
+THREAD_WAIT_TIMEOUT = 10
 
 LOCK_FILE = "/tmp/cfbot-lock"
 
@@ -57,7 +60,32 @@ else:
     PATCHBURNER_CTL = "sudo /usr/local/sbin/cfbot_patchburner_ctl.sh"
 
 CYCLE_TIME = 48.0
+# scheduling policy, see cfbot_scheduler.py (delays are PostgreSQL intervals)
+SCHEDULER_STATUSES = ["Ready for Committer", "Needs review", "Waiting on Author"]
+SCHEDULER_EXCLUDED_SUBMISSIONS = [4431, 4365]  # Joe!
+SCHEDULER_NEW_PATCH_DELAY = "-7 days"
+SCHEDULER_OVERLAP_DELAY = "-2 days"
+SCHEDULER_FAILED_DELAY = "0"
+SCHEDULER_STATUS_DELAYS = {}
 CONCURRENT_BUILDS = 4
+# If CONCURRENT_BUILDS_MAX is set, the limit is adjusted between the MIN and
+# MAX according to how long CI tasks have been waiting for a runner recently:
+# MAX while that's within QUEUE_LATENCY_TARGET seconds, and proportionally less
+# as it grows.  CONCURRENT_BUILDS is used when there is no recent data.
+CONCURRENT_BUILDS_MIN = 2
+CONCURRENT_BUILDS_MAX = 8
+QUEUE_LATENCY_TARGET = 120
+QUEUE_LATENCY_WINDOW = "30 minutes"
+# When a periodic rebuild of a submission produces the same tree as the last
+# branch that is still being tested or passed, CI would only repeat itself, so
+# don't push it.  If UNCHANGED_TREE_CI_DIRECTIVE is set, push it anyway with
+# that line added to the commit message, which the CI configuration can use to
+# run a reduced set of checks (for example "ci-os-only: linux").
+SKIP_UNCHANGED_TREES = True
+UNCHANGED_TREE_CI_DIRECTIVE = None
+# how many submissions can be applied at the same time, each in its own
+# patchburner jail or container
+PATCHBURNER_SLOTS = 1
 # work queue worker settings
 CONCURRENT_QUEUE_WORKERS = 4
 
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Run with "python3 -m unittest" from the cfbot directory.
+
+import cfbot_commitfest
+import unittest
+from unittest import mock
+
+THREAD_URL = "https://www.postgresql.org/message-id/flat/first@example.com"
+
+
+def thread_page(*message_ids):
+    """Make a 'whole thread' page that shows the given messages."""
+    return "\n".join(
+        f'<td><a href="/message-id/{message_id}">{message_id}</a></td>'
+        for message_id in message_ids
+    )
+
+
+class WaitForMessageTest(unittest.TestCase):
+    def setUp(self):
+        # no rows in thread_message, so every pull parses the whole page
+        self.conn = mock.MagicMock()
+        self.conn.cursor.return_value.fetchone.return_value = None
+        # a clock that only moves when we sleep
+        self.now = 1000.0
+        patcher = mock.patch("time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("time.sleep", side_effect=self.advance)
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def test_message_appears_late(self):
+        with mock.patch(
+            "cfbot_util.slow_fetch",
+            side_effect=[
+                thread_page("first@example.com"),
+                thread_page("first@example.com", "second@example.com"),
+            ],
+        ) as slow_fetch:
+            self.assertTrue(
+                cfbot_commitfest.wait_for_message(
+                    self.conn, THREAD_URL, "second@example.com", 10
+                )
+            )
+        self.assertEqual(slow_fetch.call_count, 2)
+        self.sleep.assert_called_once_with(0.5)
+
+    def test_message_never_appears(self):
+        with mock.patch(
+            "cfbot_util.slow_fetch", return_value=thread_page("first@example.com")
+        ):
+            self.assertFalse(
+                cfbot_commitfest.wait_for_message(
+                    self.conn, THREAD_URL, "second@example.com", 10
+                )
+            )
+        self.assertEqual(
+            [call.args[0] for call in self.sleep.call_args_list], [0.5, 1, 2, 4]
+        )
+
+    def test_no_expected_message(self):
+        with mock.patch(
+            "cfbot_util.slow_fetch", return_value=thread_page("first@example.com")
+        ) as slow_fetch:
+            self.assertTrue(
+                cfbot_commitfest.wait_for_message(self.conn, THREAD_URL, None, 10)
+            )
+        self.assertEqual(slow_fetch.call_count, 1)
+        self.sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()